@@ -14,61 +14,68 @@
 #  DB 12   ; a decimal byte
 #  DB 0b0001 ; a binary byte
 
+import json
+import os
 import sys
 import re
 
+# The instruction set is described once, in ../ls8/isa.py, and the .ls8b
+# image format in ../ls8/image.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "ls8"))
+import image
+import isa
+import peephole
+
+# Operand layout -> opcode type: 0, 1 or 2 registers, 8 for a register and
+# an immediate
+OPERAND_TYPES = {"": 0, "r": 1, "rr": 2, "ri": 8}
+
 # Opcodes
 OPCODES = {
-    "ADD":  {"type": 2, "code": "10100000"},
-    "AND":  {"type": 2, "code": "10101000"},
-    "CALL": {"type": 1, "code": "01010000"},
-    "CMP":  {"type": 2, "code": "10100111"},
-    "DEC":  {"type": 1, "code": "01100110"},
-    "DIV":  {"type": 2, "code": "10100011"},
-    "HLT":  {"type": 0, "code": "00000001"},
-    "INC":  {"type": 1, "code": "01100101"},
-    "INT":  {"type": 1, "code": "01010010"},
-    "IRET": {"type": 0, "code": "00010011"},
-    "JEQ":  {"type": 1, "code": "01010101"},
-    "JGE":  {"type": 1, "code": "01011010"},
-    "JGT":  {"type": 1, "code": "01010111"},
-    "JLE":  {"type": 1, "code": "01011001"},
-    "JLT":  {"type": 1, "code": "01011000"},
-    "JMP":  {"type": 1, "code": "01010100"},
-    "JNE":  {"type": 1, "code": "01010110"},
-    "LD":   {"type": 2, "code": "10000011"},
-    "LDI":  {"type": 8, "code": "10000010"},
-    "MOD":  {"type": 2, "code": "10100100"},
-    "MUL":  {"type": 2, "code": "10100010"},
-    "NOP":  {"type": 0, "code": "00000000"},
-    "NOT":  {"type": 1, "code": "01101001"},
-    "OR":   {"type": 2, "code": "10101010"},
-    "POP":  {"type": 1, "code": "01000110"},
-    "PRA":  {"type": 1, "code": "01001000"},
-    "PRN":  {"type": 1, "code": "01000111"},
-    "PUSH": {"type": 1, "code": "01000101"},
-    "RET":  {"type": 0, "code": "00010001"},
-    "SHL":  {"type": 2, "code": "10101100"},
-    "SHR":  {"type": 2, "code": "10101101"},
-    "ST":   {"type": 2, "code": "10000100"},
-    "SUB":  {"type": 2, "code": "10100001"},
-    "XOR":  {"type": 2, "code": "10101011"},
+    ins.name: {"type": OPERAND_TYPES[ins.operands], "code": f"{ins.opcode:08b}"}
+    for ins in isa.INSTRUCTIONS
 }
 
+# The source map asm.py -g writes next to its output, see ls8/sourcemap.py
+DEBUG_SUFFIX = ".map"
+DEBUG_VERSION = 1
+
+# Opcode values as integers
+OPCODE_VALUES = {name: int(info["code"], 2) for name, info in OPCODES.items()}
+
 # Regex for matching lines
 # Capturing groups: label, opcode, operandA, operandB
-REGEX = r"(?:(\w+?):)?\s*(?:(\w+)\s*(?:(\w+)(?:\s*,\s*(\w+))?)?)?"
+REGEX = re.compile(r"(?:(\w+?):)?\s*(?:(\w+)\s*(?:(\w+)(?:\s*,\s*(\w+))?)?)?")
 
 # Regex for capturing DS and DB data
-REGEX_DS = r"(?:(\w+?):)?\s*DS\s*(.+)"  # insensitive
-REGEX_DB = r"(?:(\w+?):)?\s*DB\s*(.+)"  # insensitive
+REGEX_DS = re.compile(r"(?:(\w+?):)?\s*DS\s*(.+)", re.IGNORECASE)
+REGEX_DB = re.compile(r"(?:(\w+?):)?\s*DB\s*(.+)", re.IGNORECASE)
+
+# Regex for register operands
+REGEX_REG = re.compile(r"R([0-7])")
+
+
+class AssemblerError(Exception):
+    """An error in the source, status is the exit code of the CLI"""
+
+    def __init__(self, message, status=1):
+        super().__init__(message)
+        self.status = status
 
 
 def parse_commandline(argv):
     """
-    Usage: asm.py [inputfile] [outputfile]
+    Usage: asm.py [-g] [-O] [inputfile] [outputfile]
+
+    An outputfile ending in .ls8b gets a binary image instead of text. -g
+    also writes the source map to outputfile + DEBUG_SUFFIX, -O runs the
+    peephole optimizer (see peephole.py).
     """
 
+    debug = "-g" in argv[1:]
+    optimize = "-O" in argv[1:]
+    argv = [arg for arg in argv if arg not in ("-g", "-O")]
+
     if len(argv) == 1:
         inputfile = "-"
         outputfile = "-"
@@ -82,10 +89,14 @@ def parse_commandline(argv):
         outputfile = argv[2]
 
     else:
-        print("usage: asm.py [infile.asm] [outfile.ls8]", file=sys.stderr)
+        print("usage: asm.py [-g] [-O] [infile.asm] [outfile.ls8]", file=sys.stderr)
         sys.exit(1)
 
-    return inputfile, outputfile
+    if debug and outputfile == "-":
+        print("asm.py: -g needs an output file", file=sys.stderr)
+        sys.exit(1)
+
+    return inputfile, outputfile, debug, optimize
 
 
 def open_files(inputfile, outputfile):
@@ -101,6 +112,8 @@ def open_files(inputfile, outputfile):
 
     if outputfile == "-":
         outputfile = sys.stdout
+    elif outputfile.endswith(".ls8b"):
+        outputfile = open(outputfile, "wb")
     else:
         outputfile = open(outputfile, "w")
 
@@ -127,34 +140,30 @@ def p8(v):
     return "{:08b}".format(v)
 
 
-def pass1(inputfile, sym, code):
+def pass1(inputfile, sym, code, fixups, notes, lines=None):
     """
     Pass 1
 
     * Read the source code lines
     * Parse labels, opcodes, and operands
     * Record label offsets
-    * Emit machine code
+    * Emit machine code as integers, with a 0 placeholder and a fixup
+      (address, symbol, line number) for every symbol operand
+    * Record a comment for the text output in notes, by address
+    * Record the source line number of every byte in lines, if given
     """
 
     # Source line number
     line_num = 0
 
-    # Current code address (for labels)
-    addr = 0
-
     def get_reg(op, fatal=True):
         """Get a register number from a string, e.g. "R2" -> 2"""
 
-        nonlocal line_num
-
-        m = re.match(r"R([0-7])", op)
+        m = REGEX_REG.match(op)
 
         if m is None:
             if fatal:
-                print(f"Line {line_num}: unknown register {op}",
-                      file=sys.stderr)
-                sys.exit(1)
+                raise AssemblerError(f"Line {line_num}: unknown register {op}")
             else:
                 return None
 
@@ -163,68 +172,61 @@ def pass1(inputfile, sym, code):
     def out0(opcode, op_a, op_b, machine_code):
         """Handle opcodes with zero operands"""
 
-        nonlocal addr
-
-        code.append(f"{machine_code} # {opcode}")
-        addr += 1
+        notes[len(code)] = opcode
+        code.append(machine_code)
 
     def out1(opcode, op_a, op_b, machine_code):
         """Handle opcodes with one operand"""
 
-        nonlocal addr
-
         reg_a = get_reg(op_a)
-        code.append(f"{machine_code} # {opcode} {op_a}")
-        code.append(p8(reg_a))
-        addr += 2
+        notes[len(code)] = f"{opcode} {op_a}"
+        code.append(machine_code)
+        code.append(reg_a)
 
     def out2(opcode, op_a, op_b, machine_code):
         """Handle opcodes with two operands"""
 
-        nonlocal addr
-
         reg_a = get_reg(op_a)
         reg_b = get_reg(op_b)
 
-        code.append(f"{machine_code} # {opcode} {op_a},{op_b}")
-        code.append(p8(reg_a))
-        code.append(p8(reg_b))
-
-        addr += 3
+        notes[len(code)] = f"{opcode} {op_a},{op_b}"
+        code.append(machine_code)
+        code.append(reg_a)
+        code.append(reg_b)
 
     def out8(opcode, op_a, op_b, machine_code):
         """Handle LDI opcode (type 8)"""
 
-        nonlocal addr
-
         reg_a = get_reg(op_a)
 
+        notes[len(code)] = f"{opcode} {op_a},{op_b}"
+        code.append(machine_code)
+        code.append(reg_a)
+
         try:
             val_b = int(op_b, 0)
-            out_b = p8(val_b)
 
         except ValueError:
-            # If it's not a value, it might be a symbol
-            out_b = f"sym:{op_b}"
+            # If it's not a value, it might be a symbol, patched in once
+            # all the labels are known
+            fixups.append((len(code), op_b, line_num))
+            val_b = 0
 
-        code.append(f"{machine_code} # {opcode} {op_a},{op_b}")
-        code.append(p8(reg_a))
-        code.append(out_b)
+        if not 0 <= val_b <= 0xFF:
+            raise AssemblerError(
+                f"Line {line_num}: immediate {op_b} doesn't fit in a byte")
 
-        addr += 3
+        code.append(val_b)
 
     def handle_ds(line):
         """
         Handle DS pseudo-opcode
         """
 
-        nonlocal addr
-
-        m = re.match(REGEX_DS, line, re.IGNORECASE)
+        m = REGEX_DS.match(line)
 
         if m is None or m.group(2) is None:
-            print(f"line {line_num}: missing argument to DS", file=sys.stderr)
-            sys.exit(2)
+            raise AssemblerError(f"line {line_num}: missing argument to DS", 2)
 
         data = m.group(2)
 
@@ -234,22 +236,18 @@ def pass1(inputfile, sym, code):
             if print_char == ' ':
                 print_char = '[space]'
 
-            code.append(f"{p8(ord(data[i]))} # {print_char}")
-
-        addr += len(data)
+            notes[len(code)] = print_char
+            code.append(ord(data[i]))
 
     def handle_db(line):
         """
         Handle the DB pseudo-opcode
         """
 
-        nonlocal addr
-
-        m = re.match(REGEX_DB, line, re.IGNORECASE)
+        m = REGEX_DB.match(line)
 
         if m is None or m.group(2) is None:
-            print(f"line {line}: missing argument to DB", file=sys.stderr)
-            sys.exit(2)
+            raise AssemblerError(f"line {line}: missing argument to DB", 2)
 
         data = m.group(2)
 
@@ -257,16 +255,14 @@ def pass1(inputfile, sym, code):
             val = int(data, 0)
 
         except ValueError:
-            print(f"line {line_num}: invalid integer argument to DB",
-                  file=sys.stderr)
-            sys.exit(2)
+            raise AssemblerError(
+                f"line {line_num}: invalid integer argument to DB", 2)
 
         # Force to byte size
         val &= 0xff
 
-        code.append(f"{p8(val)} # {data}")
-
-        addr += 1
+        notes[len(code)] = data
+        code.append(val)
 
     def check_ops(opcode, op_a, op_b):
         """Check operands for sanity with a particular opcode"""
@@ -274,18 +270,15 @@ def pass1(inputfile, sym, code):
         def check_ops_count(desired, found):
             # Makes sure we have right operand count
             if found < desired:
-                print(f"Line {line_num}: missing operand to {opcode}",
-                      file=sys.stderr)
-                sys.exit(1)
+                raise AssemblerError(
+                    f"Line {line_num}: missing operand to {opcode}")
             elif found > desired:
-                print(f"Line {line_num}: unexpected operand to {opcode}",
-                      file=sys.stderr)
-                sys.exit(1)
+                raise AssemblerError(
+                    f"Line {line_num}: unexpected operand to {opcode}")
 
         # Make sure we know this opcode at all
         if opcode not in OPCODES:
-            print(f"line {line_num}: unknown opcode {opcode}", file=sys.stderr)
-            sys.exit(2)
+            raise AssemblerError(f"line {line_num}: unknown opcode {opcode}", 2)
 
         op_type = OPCODES[opcode]["type"]
 
@@ -325,23 +318,19 @@ def pass1(inputfile, sym, code):
         line = line.strip()
 
         # Ignore blank lines
-        if input == '':
+        if line == '':
             continue
 
-        # print(line)  # debug
-
-        m = re.match(REGEX, line)
+        m = REGEX.match(line)
 
         if m is not None:
             label, opcode, op_a, op_b = normalize_line(m.groups())
 
-            # print(label, opcode, op_a, op_b)  # debug
-
             # Track label address
             if label is not None:
-                sym[label] = addr
-                # print(f"Label {label}: {addr}")  # debug
-                code.append(f'# {label} (address {addr}):')
+                sym[label] = len(code)
+
+            start = len(code)
 
             if opcode is not None:
                 if opcode == 'DS':
@@ -353,37 +342,150 @@ def pass1(inputfile, sym, code):
                     check_ops(opcode, op_a, op_b)
 
                     # Handle opcodes
-                    op_info = OPCODES[opcode]
-                    handler = type_f[op_info["type"]]
-                    handler(opcode, op_a, op_b, op_info["code"])
+                    handler = type_f[OPCODES[opcode]["type"]]
+                    handler(opcode, op_a, op_b, OPCODE_VALUES[opcode])
+
+            if lines is not None:
+                for address in range(start, len(code)):
+                    lines[address] = line_num
         else:
-            print(f"No match: {input}", file=sys.stderr)
-            sys.exit(3)
+            raise AssemblerError(f"No match: {line}", 3)
 
 
-def pass2(outputfile, sym, code):
+def resolve(sym, code, fixups):
     """
-    Output the code, substituting in any symbols.
+    Patch the address of every symbol operand into the code.
     """
 
-    for c in code:
-        # Replace symbols
-        if c[:4] == 'sym:':
-            s = c[4:].strip()
+    for address, s, line_num in fixups:
+        if s not in sym:
+            raise AssemblerError(f"unknown symbol: {s}", 2)
 
-            if s in sym:
-                c = p8(sym[s])
+        if sym[s] > 0xFF:
+            raise AssemblerError(
+                f"Line {line_num}: {s} is at address {sym[s]}, past the end of RAM")
+
+        code[address] = sym[s]
+
+
+def pass2(outputfile, sym, code, notes):
+    """
+    Output the code as annotated binary text, with a comment line for
+    every label.
+    """
+
+    labels = {}
+    for label, address in sym.items():
+        labels.setdefault(address, []).append(label)
+
+    for address in range(len(code) + 1):
+        for label in labels.get(address, []):
+            outputfile.write(f"# {label} (address {address}):\n")
+
+        if address == len(code):
+            break
+
+        if address in notes:
+            outputfile.write(f"{p8(code[address])} # {notes[address]}\n")
+        else:
+            outputfile.write(f"{p8(code[address])}\n")
 
-            else:
-                print(f"unknown symbol: {s}", file=sys.stderr)
-                sys.exit(2)
 
-        outputfile.write(f"{c}\n")
+def pass2_image(outputfile, sym, code):
+    """
+    Output the code as a .ls8b binary image, with the labels as its
+    symbol table.
+    """
+
+    outputfile.write(image.pack_image(code, symbols=sym))
+
+
+def debug_info(source_name, sym, code, notes, lines):
+    """
+    Return the source map of the code: for every address the source line,
+    the label it comes under and the text of the instruction or data it is
+    part of.
+    """
+
+    labels = sorted((address, label) for label, address in sym.items())
+
+    addresses = []
+    label = text = None
+    for address in range(len(code)):
+        while labels and labels[0][0] <= address:
+            label = labels.pop(0)[1]
+
+        # operand bytes have no note, they belong to the instruction before
+        text = notes.get(address, text)
+        addresses.append({"line": lines.get(address), "label": label, "text": text})
+
+    return {
+        "version": DEBUG_VERSION,
+        "source": source_name,
+        "symbols": dict(sym),
+        "addresses": addresses,
+    }
+
+
+def pass2_debug(outputfile, source_name, sym, code, notes, lines):
+    """
+    Output the source map as JSON.
+    """
+
+    json.dump(debug_info(source_name, sym, code, notes, lines), outputfile)
+    outputfile.write("\n")
+
+
+def translate(source, sym, optimize=False):
+    """
+    Run pass 1, the peephole optimizer if optimize and the symbol
+    resolution over source, an open file or an iterable of lines. Returns
+    (code, notes, lines), the labels are added to sym. Raises
+    AssemblerError on bad source.
+    """
+
+    # the machine code, the symbol operands to patch, the comments for the
+    # text output and the source line of every address
+    code = []
+    fixups = []
+    notes = {}
+    lines = {}
+
+    pass1(source, sym, code, fixups, notes, lines)
+    if optimize:
+        peephole.optimize(sym, code, fixups, notes, lines)
+    resolve(sym, code, fixups)
+
+    return code, notes, lines
+
+
+def assemble(source, sym=None, debug=None, optimize=False):
+    """
+    Assemble LS-8 source, a string or an iterable of lines, and return the
+    machine code as bytes. Labels are added to sym if a dict is given, and
+    the source map to debug. optimize runs the peephole optimizer.
+    Raises AssemblerError on bad source.
+    """
+
+    if isinstance(source, str):
+        source = source.splitlines()
+
+    if sym is None:
+        sym = {}
+
+    code, notes, lines = translate(source, sym, optimize)
+
+    if debug is not None:
+        debug.update(debug_info("<source>", sym, code, notes, lines))
+
+    return bytes(code)
 
 
 def main(argv):
     # Parse command line
-    inputfile, outputfile = parse_commandline(argv)
+    inputfile, outputfile, debug, optimize = parse_commandline(argv)
+    source_name = "<stdin>" if inputfile == "-" else os.path.basename(inputfile)
+    debug_file = outputfile + DEBUG_SUFFIX
 
     # Open files
     inputfile, outputfile = open_files(inputfile, outputfile)
@@ -391,12 +493,22 @@ def main(argv):
     # Set up the symbol table
     sym = {}
 
-    # Set up the machine code output
-    code = []
-
     # Assemble
-    pass1(inputfile, sym, code)
-    pass2(outputfile, sym, code)
+    try:
+        code, notes, lines = translate(inputfile, sym, optimize)
+
+    except AssemblerError as e:
+        print(e, file=sys.stderr)
+        return e.status
+
+    if outputfile.mode == "wb":
+        pass2_image(outputfile, sym, code)
+    else:
+        pass2(outputfile, sym, code, notes)
+
+    if debug:
+        with open(debug_file, "w") as fp:
+            pass2_debug(fp, source_name, sym, code, notes, lines)
 
     return 0
 
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+# Build driver for the LS-8 programs
+#
+# Assembles every .asm source that changed since the last build into
+# ../ls8/examples, on a process pool. A source is skipped when the hash of
+# its text (and of asm.py, peephole.py, ../ls8/isa.py, ../ls8/image.py and -O)
+# matches the one in the build cache and its output still exists.
+#
+# Usage: build.py [-j jobs] [-o outdir] [--binary] [-g] [-O] [--force] [source.asm ...]
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import asm
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_OUTDIR = os.path.join(HERE, os.pardir, "ls8", "examples")
+CACHE_FILE = os.path.join(HERE, ".buildcache.json")
+
+# the process umask, which can only be read by setting it
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def parse_commandline(argv):
+    parser = argparse.ArgumentParser(
+        prog=argv[0], description="Assemble the LS-8 programs that changed")
+    parser.add_argument("sources", nargs="*",
+                        help="the .asm files to build, all of them by default")
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="worker processes, one per core by default")
+    parser.add_argument("-o", "--outdir", default=DEFAULT_OUTDIR,
+                        help="where the programs are written")
+    parser.add_argument("--binary", action="store_true",
+                        help="write .ls8b images instead of .ls8 text")
+    parser.add_argument("-g", "--debug", action="store_true",
+                        help="write a source map next to every program")
+    parser.add_argument("-O", "--optimize", action="store_true",
+                        help="run the peephole optimizer")
+    parser.add_argument("--force", action="store_true",
+                        help="rebuild everything, ignoring the cache")
+    args = parser.parse_args(argv[1:])
+
+    if not args.sources:
+        args.sources = sorted(
+            os.path.join(HERE, name)
+            for name in os.listdir(HERE) if name.endswith(".asm"))
+
+    return args
+
+
+def load_cache():
+    try:
+        with open(CACHE_FILE) as fp:
+            return json.load(fp)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_cache(cache):
+    write_atomic(CACHE_FILE, json.dumps(cache, indent=2, sort_keys=True).encode())
+
+
+def write_atomic(path, data):
+    """
+    Write data to a temporary file next to path and move it over path, so
+    readers never see a half written file.
+    """
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".",
+                               prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(data)
+        # mkstemp makes the file 0600, give it the mode open() would have
+        os.chmod(tmp, 0o666 & ~UMASK)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def source_hash(source, assembler_hash):
+    return hashlib.sha256(assembler_hash.encode() + source).hexdigest()
+
+
+def build_one(source, outfile, binary, debug=False, optimize=False):
+    """
+    Assemble one source into outfile, and its source map next to it if
+    debug, optimized if optimize. Returns an error message, or None.
+    """
+
+    with open(source) as fp:
+        lines = fp.read().splitlines()
+
+    sym = {}
+    try:
+        code, notes, line_nums = asm.translate(lines, sym, optimize)
+    except asm.AssemblerError as e:
+        return f"{source}: {e}"
+
+    if binary:
+        out = io.BytesIO()
+        asm.pass2_image(out, sym, code)
+        data = out.getvalue()
+    else:
+        out = io.StringIO()
+        asm.pass2(out, sym, code, notes)
+        data = out.getvalue().encode()
+
+    write_atomic(outfile, data)
+
+    if debug:
+        out = io.StringIO()
+        asm.pass2_debug(out, os.path.basename(source), sym, code, notes, line_nums)
+        write_atomic(outfile + asm.DEBUG_SUFFIX, out.getvalue().encode())
+    return None
+
+
+def main(argv):
+    args = parse_commandline(argv)
+    extension = ".ls8b" if args.binary else ".ls8"
+
+    # the assembler is asm.py, its optimizer and the instruction set it
+    # reads, the image format it writes and whether it optimizes
+    assembler_hash = hashlib.sha256(b"-O" if args.optimize else b"")
+    for module in (asm, asm.peephole, asm.isa, asm.image):
+        with open(module.__file__, "rb") as fp:
+            assembler_hash.update(fp.read())
+    assembler_hash = assembler_hash.hexdigest()
+
+    cache = {} if args.force else load_cache()
+
+    # Work out what changed
+    todo = []
+    for source in args.sources:
+        name = os.path.splitext(os.path.basename(source))[0] + extension
+        outfile = os.path.join(args.outdir, name)
+
+        with open(source, "rb") as fp:
+            digest = source_hash(fp.read(), assembler_hash)
+
+        outputs = [outfile]
+        if args.debug:
+            outputs.append(outfile + asm.DEBUG_SUFFIX)
+
+        if cache.get(outfile) == digest and all(map(os.path.exists, outputs)):
+            continue
+
+        todo.append((source, outfile, digest))
+
+    if not todo:
+        print("Nothing to build")
+        return 0
+
+    os.makedirs(args.outdir, exist_ok=True)
+
+    # Assemble on a process pool
+    status = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = [
+            (pool.submit(build_one, source, outfile, args.binary, args.debug,
+                         args.optimize),
+             outfile, digest)
+            for source, outfile, digest in todo
+        ]
+
+        for future, outfile, digest in futures:
+            error = future.result()
+
+            if error is None:
+                cache[outfile] = digest
+                print(f"Built {os.path.relpath(outfile)}")
+            else:
+                cache.pop(outfile, None)
+                print(error, file=sys.stderr)
+                status = 2
+
+    save_cache(cache)
+
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
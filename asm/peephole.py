@@ -0,0 +1,393 @@
+# Peephole optimizer for the LS-8 assembler
+#
+# Runs between pass1 and resolve when asm.py is given -O. The code pass1
+# emitted is cut back into units, each an instruction or a byte of data,
+# rewritten until nothing changes and laid out again, with the labels,
+# fixups, notes and source lines moved along. The rewrites:
+#
+# * an LDI of a value its register is known to hold already is dropped
+# * ADD Rx,Ry and SUB Rx,Ry with Ry known to hold 1 become INC Rx and DEC Rx
+# * a jump to "LDI Rx,label / JMP Rx" (the same Rx) goes straight to label
+# * a jump through a register holding the same target as another register
+#   jumps through the lower numbered one
+# * an LDI of a register that is written again before anything reads it is
+#   dropped, so the last two leave their LDI behind
+# * instructions after JMP, RET, IRET or HLT are dropped up to the next label
+#   an LDI loads
+#
+# Values are known from the LDIs since the last label, and jump targets
+# from the value of the register jumped through. The program must reach
+# its code through labels only: don't optimize one that jumps to numeric
+# addresses. Interrupt handlers are taken not to read the registers of the
+# code they interrupt. R5-R7 (IM, IS and SP) are never touched, and every
+# register keeps its value up to HLT.
+
+import isa
+
+# the registers the optimizer tracks and rewrites
+TRACKED = range(5)
+
+SP = 7
+
+CONDITIONAL = {isa.NAMES[opcode] for opcode in isa.CONDITIONS}
+
+# jumps through a register
+JUMPS = {"JMP", "CALL"} | CONDITIONAL
+
+# instructions never followed by the next one
+STOPS = {"JMP", "RET", "IRET", "HLT"}
+
+
+def decode(sym, code, fixups, notes, lines):
+    """
+    Cut the code into units, returns them and the labels past the end.
+    """
+
+    labels = {}
+    for label, address in sym.items():
+        labels.setdefault(address, []).append(label)
+
+    symbols = {address: s for address, s, line_num in fixups}
+
+    units = []
+    address = 0
+
+    while address < len(code):
+        note = notes.get(address)
+        name = note.partition(" ")[0] if note else None
+
+        # pass1 notes every instruction with its text, and every DS and DB
+        # byte with the data, which never reads as an opcode
+        if name in isa.BY_NAME and code[address] == isa.OPCODES[name]:
+            operands = isa.BY_NAME[name].operands
+            unit = {"name": name, "a": None, "b": None}
+            if operands:
+                unit["a"] = code[address + 1]
+            if len(operands) == 2:
+                unit["b"] = symbols.get(address + 2, code[address + 2])
+            size = len(operands) + 1
+        else:
+            unit = {"name": None, "byte": code[address]}
+            size = 1
+
+        unit["labels"] = labels.get(address, [])
+        unit["line"] = lines.get(address)
+        unit["note"] = note
+        units.append(unit)
+        address += size
+
+    return units, labels.get(len(code), [])
+
+
+def text(unit):
+    """
+    The note of a rewritten instruction.
+    """
+
+    name, a, b = unit["name"], unit["a"], unit["b"]
+    operands = isa.BY_NAME[name].operands
+
+    if operands == "r":
+        return f"{name} R{a}"
+    elif operands == "rr":
+        return f"{name} R{a},R{b}"
+    elif operands == "ri":
+        return f"{name} R{a},{b}"
+
+    return name
+
+
+def layout(units, end_labels, sym, code, fixups, notes, lines):
+    """
+    Emit the units from address 0 into the emptied tables, and move their
+    labels in sym.
+    """
+
+    code.clear()
+    fixups.clear()
+    notes.clear()
+    lines.clear()
+
+    for unit in units:
+        address = len(code)
+
+        for label in unit["labels"]:
+            sym[label] = address
+
+        if unit["name"] is None:
+            code.append(unit["byte"])
+        else:
+            operands = isa.BY_NAME[unit["name"]].operands
+            code.append(isa.OPCODES[unit["name"]])
+            if operands:
+                code.append(unit["a"])
+            if len(operands) == 2:
+                b = unit["b"]
+                if isinstance(b, str):
+                    # patched in by resolve
+                    fixups.append((len(code), b, unit["line"]))
+                    b = 0
+                code.append(b)
+
+        notes[address] = unit["note"] or text(unit)
+
+        if unit["line"] is not None:
+            for i in range(address, len(code)):
+                lines[i] = unit["line"]
+
+    for label in end_labels:
+        sym[label] = len(code)
+
+
+def reads(unit):
+    """
+    The registers an instruction reads, None for any of them.
+    """
+
+    ins = isa.BY_NAME[unit["name"]]
+
+    # a subroutine, handler, caller or the interrupted code runs next, and
+    # every register is kept up to HLT
+    if ins.writes == "*" or ins.name in ("RET", "IRET", "HLT"):
+        return None
+
+    if ins.operands == "rr":
+        return {unit["a"], unit["b"]}
+    elif ins.operands == "r" or ins.name == "ADDI":
+        return {unit["a"]}
+
+    return set()
+
+
+def writes(unit):
+    """
+    The registers an instruction writes.
+    """
+
+    ins = isa.BY_NAME[unit["name"]]
+
+    if ins.writes == "*":
+        return set(range(8))
+
+    return {unit["a"] if reg == "a" else SP for reg in ins.writes.split()}
+
+
+def track(units):
+    """
+    Return the values the tracked registers are known to hold as each unit
+    starts, by following the LDIs since the last label.
+    """
+
+    values = []
+    known = {}
+
+    for unit in units:
+        if unit["labels"] or unit["name"] is None:
+            known = {}
+
+        values.append(known)
+
+        if unit["name"] is not None:
+            known = {reg: v for reg, v in known.items() if reg not in writes(unit)}
+
+            if unit["name"] == "LDI" and unit["a"] in TRACKED:
+                known[unit["a"]] = unit["b"]
+
+    return values
+
+
+def successors(units, i, values, index):
+    """
+    The units that can run after units[i], None if that isn't known.
+    """
+
+    unit = units[i]
+    name = unit["name"]
+
+    if name in JUMPS:
+        target = values[i].get(unit["a"])
+
+        if name == "CALL" or target not in index:
+            return None
+        elif name == "JMP":
+            return [index[target]]
+
+        return [index[target], i + 1]
+
+    elif name in STOPS:
+        return None
+
+    return [i + 1]
+
+
+def live(units, starts, reg, values, index):
+    """
+    Whether reg may be read before it is written on a path from starts.
+    """
+
+    todo = list(starts)
+    seen = set()
+
+    while todo:
+        i = todo.pop()
+        if i in seen:
+            continue
+        seen.add(i)
+
+        # running off the end or into data
+        if i >= len(units) or units[i]["name"] is None:
+            return True
+
+        read = reads(units[i])
+        if read is None or reg in read:
+            return True
+
+        if reg in writes(units[i]):
+            continue
+
+        nexts = successors(units, i, values, index)
+        if nexts is None:
+            return True
+        todo.extend(nexts)
+
+    return False
+
+
+def thread(units, target, reg, index):
+    """
+    Follow "LDI reg,label / JMP reg" chains from target, returns where they
+    end, or None for a cycle.
+    """
+
+    seen = set()
+
+    while target in index and target not in seen:
+        seen.add(target)
+        i = index[target]
+
+        if not (i + 1 < len(units) and units[i]["name"] == "LDI"
+                and units[i]["a"] == reg and units[i + 1]["name"] == "JMP"
+                and units[i + 1]["a"] == reg and not units[i + 1]["labels"]):
+            return target
+
+        target = units[i]["b"]
+
+    if target in seen:
+        return None
+
+    return target
+
+
+def remove(units, end_labels, i):
+    """
+    Drop units[i], its labels go to the unit after it.
+    """
+
+    labels = units.pop(i)["labels"]
+
+    if i < len(units):
+        units[i]["labels"] = labels + units[i]["labels"]
+    else:
+        end_labels[:0] = labels
+
+
+def loader(units, i, reg):
+    """
+    The index of the LDI that loaded reg for units[i], with nothing after
+    it reading or writing reg, or None.
+    """
+
+    for j in range(i - 1, -1, -1):
+        if units[j]["labels"] or units[j]["name"] is None:
+            return None
+
+        if units[j]["name"] == "LDI" and units[j]["a"] == reg:
+            return j
+
+        read = reads(units[j])
+        if read is None or reg in read or reg in writes(units[j]):
+            return None
+
+    return None
+
+
+def rewrite(units, end_labels):
+    """
+    Make the first rewrite that applies, returns whether there was one.
+    """
+
+    values = track(units)
+
+    index = {label: i for i, unit in enumerate(units) for label in unit["labels"]}
+    for label in end_labels:
+        index[label] = len(units)
+
+    # the labels code can get to other than by falling through
+    loaded = {unit["b"] for unit in units if unit["name"] == "LDI"}
+
+    for i, unit in enumerate(units):
+        name = unit["name"]
+
+        if name is None:
+            continue
+
+        a, b = unit["a"], unit["b"]
+        known = values[i]
+
+        # Unreachable code
+        if (name in STOPS and i + 1 < len(units) and units[i + 1]["name"] is not None
+                and not loaded.intersection(units[i + 1]["labels"])):
+            remove(units, end_labels, i + 1)
+            return True
+
+        if name == "LDI" and a in TRACKED:
+            # A value the register holds already
+            if a in known and known[a] == b:
+                remove(units, end_labels, i)
+                return True
+
+            # A value nothing reads
+            if not live(units, [i + 1], a, values, index):
+                remove(units, end_labels, i)
+                return True
+
+        # Adding or subtracting 1
+        if name in ("ADD", "SUB") and known.get(b) == 1:
+            unit.update(name="INC" if name == "ADD" else "DEC", b=None, note=None)
+            return True
+
+        if name in JUMPS and a in known:
+            # Another register holds the target already
+            reg = min(reg for reg in known if known[reg] == known[a])
+            if reg != a:
+                unit.update(a=reg, note=None)
+                return True
+
+            # The target is a jump to somewhere else
+            j = loader(units, i, a)
+            target = None if j is None else thread(units, units[j]["b"], a, index)
+
+            if target is not None and target != units[j]["b"]:
+                # JMP and CALL find Rx the same at the final target, the
+                # fall through of a conditional jump mustn't read it
+                if name in ("JMP", "CALL") or not live(units, [i + 1], a, values, index):
+                    units[j].update(b=target, note=None)
+                    return True
+
+    return False
+
+
+def optimize(sym, code, fixups, notes, lines):
+    """
+    Optimize the output of pass1 in place, returns the number of rewrites.
+    """
+
+    units, end_labels = decode(sym, code, fixups, notes, lines)
+
+    count = 0
+    while rewrite(units, end_labels):
+        count += 1
+
+    layout(units, end_labels, sym, code, fixups, notes, lines)
+
+    return count
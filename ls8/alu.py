@@ -0,0 +1,109 @@
+"""ALU operations, looked up by the raw opcode byte of the instruction.
+
+They are the branch_table handlers of the ALU instructions as well (see
+handlers.py), so they move the PC past the instruction. CPU.alu leaves
+num_operands at 0 and the PC where it is."""
+
+import helpers as hp
+import isa
+
+
+def alu_ADD(self, reg_a, reg_b, num_operands=0):
+    self.registers[reg_a] = (self.registers[reg_a] + self.registers[reg_b]) & 0xFF
+    self.PC += num_operands
+
+
+def alu_SUB(self, reg_a, reg_b, num_operands=0):
+    self.registers[reg_a] = (self.registers[reg_a] - self.registers[reg_b]) & 0xFF
+    self.PC += num_operands
+
+
+def alu_MUL(self, reg_a, reg_b, num_operands=0):
+    self.registers[reg_a] = (self.registers[reg_a] * self.registers[reg_b]) & 0xFF
+    self.PC += num_operands
+
+
+def alu_CMP(self, reg_a, reg_b, num_operands=0):
+    hp.set_FL_kth_bit(self, reg_a, reg_b)
+    self.PC += num_operands
+
+
+def alu_AND(self, reg_a, reg_b, num_operands=0):
+    self.registers[reg_a] &= self.registers[reg_b]
+    self.PC += num_operands
+
+
+def alu_OR(self, reg_a, reg_b, num_operands=0):
+    self.registers[reg_a] |= self.registers[reg_b]
+    self.PC += num_operands
+
+
+def alu_XOR(self, reg_a, reg_b, num_operands=0):
+    self.registers[reg_a] ^= self.registers[reg_b]
+    self.PC += num_operands
+
+
+def alu_NOT(self, reg_a, reg_b, num_operands=0):
+    self.registers[reg_a] = ~self.registers[reg_a] & 0xFF
+    self.PC += num_operands
+
+
+def alu_SHL(self, reg_a, reg_b, num_operands=0):
+    self.registers[reg_a] = (self.registers[reg_a] << self.registers[reg_b]) & 0xFF
+    self.PC += num_operands
+
+
+def alu_SHR(self, reg_a, reg_b, num_operands=0):
+    self.registers[reg_a] >>= self.registers[reg_b]
+    self.PC += num_operands
+
+
+def alu_DIV(self, reg_a, reg_b, num_operands=0):
+    if self.registers[reg_b] == 0:
+        division_by_zero(self)
+    else:
+        self.registers[reg_a] //= self.registers[reg_b]
+    self.PC += num_operands
+
+
+def alu_MOD(self, reg_a, reg_b, num_operands=0):
+    if self.registers[reg_b] == 0:
+        division_by_zero(self)
+    else:
+        self.registers[reg_a] %= self.registers[reg_b]
+    self.PC += num_operands
+
+
+DIVISION_BY_ZERO = "Can't perform a division over 0, second value can't be 0."
+
+
+def division_by_zero(self):
+    self.output.message(DIVISION_BY_ZERO)
+    self.halted = True
+    self.halt_reason = "division by 0"
+
+
+def alu_ADDI(self, reg_a, value, num_operands=0):
+    self.registers[reg_a] = (self.registers[reg_a] + value) & 0xFF
+    self.PC += num_operands
+
+
+def alu_INC(self, reg_a, reg_b, num_operands=0):
+    self.registers[reg_a] = (self.registers[reg_a] + 1) & 0xFF
+    self.PC += num_operands
+
+
+def alu_DEC(self, reg_a, reg_b, num_operands=0):
+    self.registers[reg_a] = (self.registers[reg_a] - 1) & 0xFF
+    self.PC += num_operands
+
+
+def alu_unsupported(self, reg_a, reg_b):
+    raise Exception("Unsupported ALU operation")
+
+
+# a dense table indexed by the opcode byte, every opcode that isn't an ALU
+# operation raises
+TABLE = [alu_unsupported] * 256
+for name in "ADD SUB MUL DIV CMP AND OR XOR NOT SHL SHR MOD ADDI INC DEC".split():
+    TABLE[isa.OPCODES[name]] = globals()["alu_" + name]
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of the ALU dispatch.
+
+Compares the per-op cost of the old string-compared CPU.alu reached
+through *args handlers with the opcode-indexed handlers and ALU table.
+
+    python3 bench_alu.py [iterations]
+"""
+
+import sys
+import timeit
+import alu
+import handlers as hd
+import helpers as hp
+
+OPS = ["ADD", "MUL", "CMP", "AND", "OR", "XOR", "NOT", "SHL", "SHR", "MOD",
+       "ADDI", "INC", "DEC"]
+
+
+class Machine:
+    """Just the CPU state the ALU handlers touch."""
+
+    def __init__(self):
+        self.registers = [3, 1, 0, 0, 0, 0, 0, 0xF4]
+        self.PC = 0
+        self.FL = 0
+        self.halted = False
+        self.alu_table = alu.TABLE
+
+    def alu(self, op, reg_a, reg_b=None):
+        self.alu_table[op](self, reg_a, reg_b)
+
+    def legacy_alu(self, op, reg_a, reg_b=None):
+        """CPU.alu before the opcode-indexed table."""
+        if op == "ADD":
+            self.registers[reg_a] += self.registers[reg_b]
+        elif op == "MUL":
+            self.registers[reg_a] *= self.registers[reg_b]
+        elif op == "CMP":
+            hp.set_FL_kth_bit(self, reg_a, reg_b)
+        elif op == "AND":
+            self.registers[reg_a] = (self.registers[reg_a] & self.registers[reg_b])
+        elif op == "OR":
+            self.registers[reg_a] = (self.registers[reg_a] | self.registers[reg_b])
+        elif op == "XOR":
+            self.registers[reg_a] = (self.registers[reg_a] ^ self.registers[reg_b])
+        elif op == "NOT":
+            self.registers[reg_a] = (~self.registers[reg_a])
+        elif op == "SHL":
+            self.registers[reg_a] = (self.registers[reg_a] << self.registers[reg_b])
+        elif op == "SHR":
+            self.registers[reg_a] = (self.registers[reg_a] >> self.registers[reg_b])
+        elif op == "MOD":
+            if self.registers[reg_b] == 0:
+                print("Can't perform a division over 0, second value can't be 0.")
+                self.halted = True
+            else:
+                self.registers[reg_a] = (self.registers[reg_a] % self.registers[reg_b])
+        elif op == "ADDI":
+            self.registers[reg_a] += reg_b
+        elif op == "INC":
+            self.registers[reg_a] += 1
+        elif op == "DEC":
+            self.registers[reg_a] -= 1
+        else:
+            raise Exception("Unsupported ALU operation")
+
+
+def legacy_handler(op):
+    """A handler shaped like the old *args ones in handlers.py"""
+    def handler(self, *args):
+        reg_a, reg_b, num_operands = args[0], args[1], args[2]
+        self.legacy_alu(op, reg_a, reg_b)
+        self.PC += num_operands
+    return handler
+
+
+def per_op_ns(call, machine, number):
+    """Nanoseconds per call, keeping the registers small"""
+    def timed():
+        machine.registers[0] = 3
+        call()
+    return min(timeit.repeat(timed, number=number, repeat=5)) / number * 1e9
+
+
+def main(argv):
+    number = int(argv[1]) if len(argv) > 1 else 200000
+    machine = Machine()
+    legacy_table = {getattr(hd, name): legacy_handler(name) for name in OPS}
+    branch_table = hd.DISPATCH
+
+    print(f"{'op':6}{'dispatch before':>17}{'after':>8}"
+          f"{'alu() before':>14}{'after':>8}   (ns per op)")
+    for name in OPS:
+        opcode = getattr(hd, name)
+        dispatch_before = per_op_ns(
+            lambda: legacy_table[opcode](machine, 0, 1, 3), machine, number)
+        dispatch_after = per_op_ns(
+            lambda: branch_table[opcode](machine, 0, 1, 3), machine, number)
+        alu_before = per_op_ns(
+            lambda: machine.legacy_alu(name, 0, 1), machine, number)
+        alu_after = per_op_ns(
+            lambda: machine.alu(opcode, 0, 1), machine, number)
+        print(f"{name:6}{dispatch_before:17.1f}{dispatch_after:8.1f}"
+              f"{alu_before:14.1f}{alu_after:8.1f}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""Emulator benchmark suite.
+
+Runs the example programs and a set of synthetic workloads on both the
+interpreter and the block compiler, and reports instructions/sec, startup
+time (CPU() plus load) and peak memory for each. Results can be saved as a
+baseline and later runs compared against it, flagging any workload whose
+instructions/sec dropped by more than the threshold.
+
+    python3 benchmark.py [--save-baseline] [--baseline FILE] [--json]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+import helpers as hp
+from cpu import CPU
+from devices import CaptureOutput
+from faults import Fault
+from replay import Replay
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "bench_baseline.json")
+
+# programs that never halt are stopped after this many instructions
+EXAMPLE_MAX_CYCLES = 100000
+
+# workloads shorter than this finish too fast to time, they are reported
+# but never flagged as regressions
+MIN_COMPARE_CYCLES = 10000
+
+# the examples driven by the timer or the keyboard get replayed events, so
+# their interrupts land on the same instructions every run
+EXAMPLE_EVENTS = {
+    "interrupts.ls8": [(cycle, "timer", None) for cycle in range(5000, EXAMPLE_MAX_CYCLES, 5000)],
+    "keyboard.ls8": [
+        (cycle, "key", ord("a") + cycle // 1000 % 26)
+        for cycle in range(1000, EXAMPLE_MAX_CYCLES, 1000)
+    ],
+}
+
+SYNTHETIC = {
+    # tight ALU loop, 100 x 250 iterations
+    "alu_loop": ("""
+        LDI R2,0
+        LDI R3,100
+    Outer:
+        LDI R4,250
+    Inner:
+        INC R0
+        ADD R0,R4
+        XOR R0,R3
+        MUL R0,R3
+        AND R0,R4
+        OR R0,R2
+        NOT R0
+        DEC R4
+        CMP R4,R2
+        LDI R1,Inner
+        JNE R1
+        DEC R3
+        CMP R3,R2
+        LDI R1,Outer
+        JNE R1
+        HLT
+    """, {}),
+    # 100 times a 40 deep recursion
+    "call_ret": ("""
+        LDI R2,0
+        LDI R3,100
+        LDI R1,Recurse
+    Again:
+        LDI R0,40
+        CALL R1
+        DEC R3
+        CMP R3,R2
+        LDI R4,Again
+        JNE R4
+        HLT
+    Recurse:
+        DEC R0
+        CMP R0,R2
+        LDI R4,Done
+        JEQ R4
+        PUSH R0
+        CALL R1
+        POP R0
+    Done:
+        RET
+    """, {}),
+    # PUSH/POP churn, 100 x 250 iterations
+    "push_pop": ("""
+        LDI R2,0
+        LDI R4,100
+    Outer:
+        LDI R3,250
+        LDI R1,Loop
+    Loop:
+        PUSH R3
+        PUSH R4
+        POP R0
+        PUSH R0
+        POP R0
+        POP R0
+        DEC R3
+        CMP R3,R2
+        JNE R1
+        DEC R4
+        CMP R4,R2
+        LDI R1,Outer
+        JNE R1
+        HLT
+    """, {}),
+    # ST/LD over addresses 200 down to 65, 100 times
+    "st_ld_sweep": ("""
+        LDI R2,64
+        LDI R4,164
+    Outer:
+        LDI R3,200
+        LDI R1,Sweep
+    Sweep:
+        ST R3,R4
+        LD R0,R3
+        ADD R0,R4
+        ST R3,R0
+        DEC R3
+        CMP R3,R2
+        JNE R1
+        DEC R4
+        CMP R4,R2
+        LDI R1,Outer
+        JNE R1
+        HLT
+    """, {}),
+    # a timer interrupt every 50 instructions into a spin loop
+    "interrupts": ("""
+        LDI R0,0xF8
+        LDI R1,Handler
+        ST R0,R1
+        LDI R5,1
+        LDI R0,Loop
+    Loop:
+        INC R3
+        JMP R0
+    Handler:
+        INC R4
+        IRET
+    """, {"timer_cycles": 50, "max_cycles": 200000}),
+}
+
+ENGINES = ["interpreter", "jit"]
+
+
+def workloads():
+    """Return (name, program bytes or file name, settings) for every workload"""
+    examples = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples")
+    result = [
+        (f"examples/{name}", os.path.join(examples, name),
+         {"max_cycles": EXAMPLE_MAX_CYCLES, "replay": EXAMPLE_EVENTS.get(name)})
+        for name in sorted(os.listdir(examples)) if name.endswith(".ls8")
+    ]
+    asm = hp.assembler()
+    for name, (source, settings) in SYNTHETIC.items():
+        result.append((name, asm.assemble(source), settings))
+    return result
+
+
+def start(program, settings, engine):
+    """Construct and load a CPU ready to run the workload"""
+    cpu = CPU()
+    cpu.output = CaptureOutput()
+    if engine == "jit":
+        cpu.use_jit()
+    if isinstance(program, str):
+        cpu.load(program)
+    else:
+        cpu.load_bytes(program)
+    cpu.timer_cycles = settings.get("timer_cycles")
+    if settings.get("replay") is not None:
+        cpu.replay = Replay(settings["replay"])
+    return cpu
+
+
+def run_workload(cpu, settings):
+    try:
+        cpu.run(settings.get("max_cycles"), interactive=False)
+    except Fault:
+        pass  # stackoverflow.ls8 is meant to end in one
+
+
+def measure(program, settings, engine, repeat):
+    """Best of repeat runs of one workload on one engine"""
+    best_run = best_startup = None
+    for _ in range(repeat):
+        began = time.perf_counter()
+        cpu = start(program, settings, engine)
+        loaded = time.perf_counter()
+        run_workload(cpu, settings)
+        finished = time.perf_counter()
+
+        startup, run = loaded - began, finished - loaded
+        best_startup = startup if best_startup is None else min(best_startup, startup)
+        best_run = run if best_run is None else min(best_run, run)
+
+    # once more for the memory, tracemalloc slows everything down
+    tracemalloc.start()
+    cpu = start(program, settings, engine)
+    run_workload(cpu, settings)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "cycles": cpu.cycles,
+        "instructions_per_second": cpu.cycles / best_run if best_run else 0.0,
+        "startup_seconds": best_startup,
+        "peak_memory_bytes": peak,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Return the workloads that got slower than threshold allows"""
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline or result["cycles"] < MIN_COMPARE_CYCLES:
+            continue
+        before = baseline[key]["instructions_per_second"]
+        after = result["instructions_per_second"]
+        if before and after < before * (1 - threshold):
+            regressions.append((key, before, after))
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog=argv[0], description="LS-8 benchmarks")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE,
+                        help="the baseline to compare with or save to")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store this run as the baseline")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="flag instructions/sec drops bigger than this")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs per workload, the best one counts")
+    parser.add_argument("--engine", choices=ENGINES, action="append",
+                        help="only benchmark this engine")
+    parser.add_argument("--json", action="store_true",
+                        help="print the results as JSON")
+    return parser.parse_args(argv[1:])
+
+
+def main(argv):
+    args = parse_args(argv)
+
+    results = {}
+    for name, program, settings in workloads():
+        for engine in args.engine or ENGINES:
+            results[f"{name}:{engine}"] = measure(program, settings, engine, args.repeat)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'workload':34}{'cycles':>9}{'instr/sec':>12}"
+              f"{'startup ms':>12}{'peak KiB':>10}")
+        for key, result in results.items():
+            print(f"{key:34}{result['cycles']:9}"
+                  f"{result['instructions_per_second']:12.0f}"
+                  f"{result['startup_seconds'] * 1000:12.3f}"
+                  f"{result['peak_memory_bytes'] / 1024:10.1f}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as fp:
+            json.dump(results, fp, indent=2)
+        print(f"baseline saved to {args.baseline}", file=sys.stderr)
+        return 0
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline, args.threshold)
+        for key, before, after in regressions:
+            print(f"REGRESSION {key}: {before:.0f} -> {after:.0f} instr/sec "
+                  f"({after / before - 1:+.1%})", file=sys.stderr)
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,584 @@
+#!/usr/bin/env python3
+"""Static analysis of LS-8 programs: basic blocks, loops, the call graph,
+dead code and the stack depth, without running them.
+
+    cpu = CPU()
+    cpu.load("printstr.ls8")
+    analysis = Analysis(cpu)
+    print(analysis.report())
+
+or `python3 cfg.py printstr.ls8 [--json FILE]`. The program is loaded as
+the emulator loads it, so .ls8, .ls8b and .asm all work, and a source map
+names the addresses.
+
+Jump and call targets come from constant propagation: the registers are
+followed through LDI and the ALU from the entry point, so the usual
+"LDI R1,label / CALL R1" resolves, and so do the interrupt vectors a
+program stores with ST. An interrupt it unmasks without storing the vector
+runs whatever the table held when it was loaded. A target computed from anything else (LD, POP, a
+register the caller passed in) is reported, and whatever it leads to is
+missing from the results. So is an ST that may write over the code. The
+stack bound is only given when nothing is missing.
+
+to_json() is metadata for an engine: the block starts and the stack
+bounds. `ls8.py --precompile` (also with --batch) hands block_starts() to
+BlockCompiler.precompile(), which compiles them before the program runs.
+"""
+
+import argparse
+import json
+import sys
+from types import SimpleNamespace
+import alu
+import helpers as hp
+import isa
+from jit import ends_block
+
+VERSION = 1
+
+# the interrupt vector table, see helpers.VECTORS
+VECTOR_TABLE = range(0xF8, 0x100)
+
+IM = 5
+SP = 7
+
+# R0-R6, what a call to something unknown can change
+ALL = frozenset(range(SP))
+
+# the state a subroutine or handler starts in
+UNKNOWN = ((None,) * SP, 0)
+
+# rounds of working out what the subroutines change before giving up and
+# taking every call to change every register
+MAX_ROUNDS = 10
+
+CONDITIONAL = {isa.NAMES[opcode] for opcode in isa.CONDITIONS}
+
+
+class Function:
+    """A subroutine, an interrupt handler or the main program, as followed
+    from its entry: the abstract state at every instruction it reaches and
+    what it jumps to, calls and returns with."""
+
+    def __init__(self, entry, kind):
+        self.entry = entry
+        self.kind = kind  # "main", "subroutine" or "interrupt"
+        # address -> (R0-R6, each a value or None if unknown, and SP
+        # relative to the entry or None)
+        self.states = {}
+        self.clear()
+
+    def clear(self):
+        """Forget what the instructions were found to do"""
+        self.edges = {}  # address -> the addresses that can run next
+        self.calls = []  # (address, target or None, SP at the call)
+        self.returns = []  # (address, SP at the RET or IRET)
+        self.unresolved = []  # jumps to a target we can't work out
+        self.invalid = []  # addresses that don't hold an instruction
+        self.vectors = {}  # vector table entry -> handler, from ST
+        self.stores = []  # (address, the address ST writes to or None)
+        self.written = set()  # the registers it writes itself
+        self.masks = set()  # the values it writes to IM, None if unknown
+
+    def depth(self):
+        """The most bytes it pushes itself, None if SP gets lost or part of
+        it couldn't be followed"""
+        deltas = [state[1] for state in self.states.values()]
+        if None in deltas or self.unresolved or self.invalid:
+            return None
+        return -min(deltas + [0])
+
+
+class Analysis:
+    """The control-flow graph and everything worked out from it, for the
+    program loaded in cpu."""
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.ram = bytes(cpu.ram)
+        self.entry = cpu.PC
+        self.end = cpu.address
+        self.top = cpu.registers[SP]  # SP at the entry
+
+        # a call keeps the registers the subroutine (and what it calls)
+        # never writes, which is only known once it has been followed
+        self.clobbers = {}  # entry -> the registers a call can change
+        for _ in range(MAX_ROUNDS):
+            self.explore()
+            clobbers = self.find_clobbers()
+            if clobbers == self.clobbers:
+                break
+            self.clobbers = clobbers
+        else:
+            self.clobbers = {}
+            self.explore()
+
+        self.blocks = self.find_blocks()
+        self.loops = self.find_loops()
+        self.dead = self.find_dead()
+
+    def explore(self):
+        """Follow the program from its entry, and every subroutine and
+        interrupt handler found on the way"""
+        self.functions = {}  # entry -> Function
+        main = Function(self.entry, "main")
+        self.functions[self.entry] = main
+        # what interrupts can enter, whatever else calls or runs it
+        self.handlers = set()
+        todo = [(main, (tuple(self.cpu.registers[:SP]), 0))]
+        while todo:
+            function, state = todo.pop()
+            self.follow(function, state)
+
+            # the subroutines it calls and the handlers it hooks up, which
+            # start out knowing nothing
+            entries = [(target, "subroutine") for _, target, _ in function.calls]
+            entries += [(handler, "interrupt") for handler in function.vectors.values()]
+            entries += [(handler, "interrupt") for handler in self.loaded_vectors(function)]
+            for target, kind in entries:
+                if target is None:
+                    continue
+                if kind == "interrupt":
+                    self.handlers.add(target)
+                if target not in self.functions:
+                    self.functions[target] = Function(target, kind)
+                    todo.append((self.functions[target], UNKNOWN))
+                    continue
+                # the main program, called or interrupted into
+                old = self.functions[target].states.get(target)
+                if old is not None and meet(old, UNKNOWN) != old:
+                    self.functions[target].states = {}
+                    todo.append((self.functions[target], meet(old, UNKNOWN)))
+
+    def loaded_vectors(self, function):
+        """The handlers of the interrupts function unmasks without storing
+        their vector itself, whatever the table held when it was loaded"""
+        masks = set(function.masks)
+        if function.entry == self.entry:
+            masks.add(self.cpu.registers[IM])
+        unmasked = 0
+        for mask in masks:
+            unmasked |= 0xFF if mask is None else mask
+        return [self.ram[entry] for bit, entry in enumerate(VECTOR_TABLE)
+                if unmasked >> bit & 1 and entry not in function.vectors]
+
+    def find_clobbers(self):
+        """entry -> the registers a call to it can change"""
+        clobbers = {}
+        for entry, f in self.functions.items():
+            lost = f.unresolved or f.invalid or any(t is None for _, t, _ in f.calls)
+            clobbers[entry] = ALL if lost else frozenset(f.written)
+        changed = True
+        while changed:
+            changed = False
+            for entry, f in self.functions.items():
+                new = clobbers[entry].union(*(clobbers.get(t, ALL) for _, t, _ in f.calls))
+                if new != clobbers[entry]:
+                    clobbers[entry] = new
+                    changed = True
+        return clobbers
+
+    def follow(self, function, state):
+        """Propagate the register values through function from its entry
+        until nothing changes. Each address keeps what every path into it
+        agrees on, so it changes at most once per register."""
+        states = function.states
+        states[function.entry] = state
+        todo = [function.entry]
+        while todo:
+            address = todo.pop()
+            for successor, new in self.step(function, address, states[address]):
+                old = states.get(successor)
+                if old is not None:
+                    new = meet(old, new)
+                if new != old:
+                    states[successor] = new
+                    todo.append(successor)
+
+        # record what every instruction does once, with the final states
+        function.clear()
+        for address in sorted(states):
+            self.step(function, address, states[address])
+
+    def step(self, function, address, state):
+        """The (address, state) pairs that can follow the instruction at
+        address, recording its edges, calls and returns in function"""
+        ram = self.ram
+        ins = isa.BY_OPCODE.get(ram[address])
+        after = address + len(ins.operands) + 1 if ins else len(ram) + 1
+        if after > len(ram):
+            function.invalid.append(address)
+            function.edges[address] = []
+            return []
+
+        a, b = ram[(address + 1) % len(ram)], ram[(address + 2) % len(ram)]
+        regs, delta = list(state[0]), state[1]
+        name = ins.name
+
+        def value(reg):
+            return regs[reg] if reg < SP else None
+
+        writes_a = ins.writes == "a" or name == "POP"
+        if writes_a:
+            function.written.add(a)
+
+        successors = [after]
+
+        if name == "LDI":
+            set_register(regs, a, b)
+            delta = None if a == SP else delta
+        elif name == "PUSH":
+            delta = None if delta is None else delta - 1
+        elif name == "POP":
+            delta = None if delta is None or a == SP else delta + 1
+            set_register(regs, a, None)
+        elif name == "ST":
+            target = value(a)
+            if target in VECTOR_TABLE and value(b) is not None:
+                function.vectors[target] = value(b)
+            else:
+                function.stores.append((address, target))
+        elif name == "INT":
+            # the handler puts every register back
+            pass
+        elif name == "CALL":
+            target = value(a)
+            function.calls.append((address, target, delta))
+            clobbers = self.clobbers.get(target, ALL)
+            regs = [None if reg in clobbers else regs[reg] for reg in range(SP)]
+        elif name in ("RET", "IRET"):
+            function.returns.append((address, delta))
+            successors = []
+        elif name == "HLT":
+            successors = []
+        elif name == "JMP" or name in CONDITIONAL:
+            target = value(a)
+            if target is None:
+                function.unresolved.append(address)
+                successors = []
+            else:
+                successors = [target]
+            if name in CONDITIONAL:
+                successors.append(after)
+        elif alu.TABLE[ins.opcode] is not alu.alu_unsupported and name != "CMP":
+            fold(ins, regs, a, b)
+            delta = None if a == SP else delta
+        elif ins.writes == "*":
+            regs = [None] * SP
+        else:
+            for reg in ins.writes.split():
+                if reg == "a":
+                    set_register(regs, a, None)
+                    delta = None if a == SP else delta
+
+        # an unmasked interrupt can dispatch from here on
+        if ins.writes == "*" or (writes_a and a == IM):
+            function.masks.add(regs[IM])
+        function.edges[address] = successors
+        state = (tuple(regs), delta)
+        return [(successor, state) for successor in successors if successor < len(ram)]
+
+    def size(self, address):
+        ins = isa.BY_OPCODE.get(self.ram[address])
+        return len(ins.operands) + 1 if ins else 1
+
+    def find_blocks(self):
+        """Split the reached instructions into basic blocks, each ending
+        where the block compiler ends one (see jit.ends_block) or before
+        the start of another, returns start -> {"end", "successors",
+        "calls"}"""
+        edges = {}
+        calls = {}
+        for function in self.functions.values():
+            for address, successors in function.edges.items():
+                edges.setdefault(address, set()).update(successors)
+            for address, target, _ in function.calls:
+                if target is not None:
+                    calls.setdefault(address, set()).add(target)
+
+        leaders = set(self.functions)
+        for address, successors in edges.items():
+            for successor in successors:
+                if successor != address + self.size(address) or ends_block(self.ram[address]):
+                    leaders.add(successor)
+
+        blocks = {}
+        for start in sorted(leaders & set(edges)):
+            address = start
+            block_calls = set()
+            while True:
+                block_calls |= calls.get(address, set())
+                # edges are empty where there's no instruction
+                if ends_block(self.ram[address]) or not edges[address]:
+                    break
+                after = address + self.size(address)
+                if after in leaders or after not in edges:
+                    break
+                address = after
+            blocks[start] = {
+                "end": address + self.size(address),
+                "successors": sorted(edges[address]),
+                "calls": sorted(block_calls),
+            }
+        return blocks
+
+    def find_loops(self):
+        """The natural loops of the block graph, header -> the blocks in
+        its loops, from the back edges of a depth first search from every
+        function's entry"""
+        loops = {}
+        for entry in self.functions:
+            back_edges = []
+            seen = set()
+            on_path = set()
+            # iterative DFS, (block, successors left)
+            stack = [(entry, iter(self.blocks[entry]["successors"]))]
+            seen.add(entry)
+            on_path.add(entry)
+            while stack:
+                block, successors = stack[-1]
+                for successor in successors:
+                    if successor in on_path:
+                        back_edges.append((block, successor))
+                    elif successor not in seen and successor in self.blocks:
+                        seen.add(successor)
+                        on_path.add(successor)
+                        stack.append((successor, iter(self.blocks[successor]["successors"])))
+                        break
+                else:
+                    stack.pop()
+                    on_path.discard(block)
+
+            predecessors = {}
+            for block, info in self.blocks.items():
+                for successor in info["successors"]:
+                    predecessors.setdefault(successor, set()).add(block)
+
+            for latch, header in back_edges:
+                body = loops.setdefault(header, {header})
+                todo = [latch]
+                while todo:
+                    block = todo.pop()
+                    if block not in body:
+                        body.add(block)
+                        todo.extend(predecessors.get(block, ()))
+        return {header: sorted(body) for header, body in loops.items()}
+
+    def find_dead(self):
+        """The (start, end) runs of program bytes no instruction reaches,
+        dead code or data"""
+        reached = set()
+        for address in self.blocks:
+            reached.update(range(address, self.blocks[address]["end"]))
+
+        runs = []
+        start = None
+        for address in range(self.end + 1):
+            if address < self.end and address not in reached:
+                if start is None:
+                    start = address
+            elif start is not None:
+                runs.append((start, address))
+                start = None
+        return runs
+
+    def call_graph(self):
+        """entry -> the entries it calls, None for a call we can't follow"""
+        return {
+            entry: sorted({target for _, target, _ in f.calls}, key=lambda t: (t is None, t))
+            for entry, f in self.functions.items()
+        }
+
+    def stack_depth(self, entry, calling=()):
+        """The most bytes function entry and what it calls push, None if it
+        recurses, loses track of SP or calls something unknown"""
+        function = self.functions[entry]
+        depth = function.depth()
+        if depth is None or entry in calling:
+            return None
+        for _, target, delta in function.calls:
+            if target is None or delta is None:
+                return None
+            inner = self.stack_depth(target, calling + (entry,))
+            if inner is None:
+                return None
+            # the return address goes on top of what the caller pushed
+            depth = max(depth, -delta + 1 + inner)
+        return depth
+
+    def max_stack_depth(self):
+        """The most bytes the program ever has on the stack, the deepest
+        interrupt frame and handler included, or None if unbounded or the
+        analysis is incomplete"""
+        if self.problems():
+            return None
+        depth = self.stack_depth(self.entry)
+        if depth is None:
+            return None
+        if self.handlers:
+            # handlers run with interrupts off, so they never nest
+            deepest = [self.stack_depth(entry) for entry in self.handlers]
+            if None in deepest:
+                return None
+            depth += hp.FRAME_SIZE + max(deepest)
+        return depth
+
+    def problems(self):
+        """What makes the results incomplete, as text"""
+        lines = []
+        name = self.cpu.name
+        for f in self.functions.values():
+            for address in f.unresolved:
+                lines.append(f"jump at {name(address)} to an unknown target")
+            for address, target, _ in f.calls:
+                if target is None:
+                    lines.append(f"call at {name(address)} to an unknown target")
+            for address in f.invalid:
+                lines.append(f"no instruction at {name(address)}")
+            for address, successors in f.edges.items():
+                if any(successor >= len(self.ram) for successor in successors):
+                    lines.append(f"{name(address)} runs off the end of memory")
+            for address, target in f.stores:
+                if target is None:
+                    lines.append(f"store at {name(address)} to an unknown address")
+                elif any(start <= target < block["end"] for start, block in self.blocks.items()):
+                    lines.append(f"store at {name(address)} over the code at "
+                                 f"{name(target)}")
+            for address, delta in f.returns:
+                if delta is None:
+                    lines.append(f"return at {name(address)} with SP unknown")
+                elif delta:
+                    lines.append(f"return at {name(address)} with SP off by {-delta}")
+        return lines
+
+    def results(self):
+        """Return everything worked out as a dict"""
+        depth = self.max_stack_depth()
+        calls = self.call_graph()
+        return {
+            "version": VERSION,
+            "entry": self.entry,
+            "end": self.end,
+            "blocks": [
+                dict(start=start, **info) for start, info in sorted(self.blocks.items())
+            ],
+            "functions": [
+                {
+                    "entry": entry,
+                    "kind": f.kind,
+                    "calls": calls[entry],
+                    "stack_depth": self.stack_depth(entry),
+                }
+                for entry, f in sorted(self.functions.items())
+            ],
+            "loops": [
+                {"header": header, "blocks": body}
+                for header, body in sorted(self.loops.items())
+            ],
+            "dead": [list(run) for run in self.dead],
+            "max_stack_depth": depth,
+            # the lowest SP the program can reach
+            "stack_low": None if depth is None else self.top - depth,
+            "problems": self.problems(),
+        }
+
+    def block_starts(self):
+        return sorted(self.blocks)
+
+    def to_json(self):
+        return json.dumps(self.results(), indent=2)
+
+    def report(self):
+        """Return the results as text"""
+        results = self.results()
+        name = self.cpu.name
+        lines = [f"entry {name(self.entry)}, {self.end} bytes, "
+                 f"{len(self.blocks)} blocks", "", "functions"]
+        for function in results["functions"]:
+            depth = function["stack_depth"]
+            lines.append(f"  {name(function['entry'])}  {function['kind']}, "
+                         f"stack {'unbounded' if depth is None else depth}")
+            for target in function["calls"]:
+                lines.append(f"    calls {'?' if target is None else name(target)}")
+
+        lines += ["", "blocks"]
+        for block in results["blocks"]:
+            successors = " ".join(map(str, block["successors"])) or "-"
+            lines.append(f"  {block['start']:3}-{block['end']:<3}  -> {successors}"
+                         f"  {name(block['start'])}")
+
+        if results["loops"]:
+            lines += ["", "loops"]
+            for loop in results["loops"]:
+                lines.append(f"  {name(loop['header'])}: blocks "
+                             + " ".join(map(str, loop["blocks"])))
+
+        if results["dead"]:
+            lines += ["", "not reached (dead code or data)"]
+            for start, end in results["dead"]:
+                lines.append(f"  {start:3}-{end:<3}  {name(start)}")
+
+        depth = results["max_stack_depth"]
+        lines += [""]
+        if depth is None:
+            lines.append("stack depth unbounded")
+        else:
+            lines.append(f"stack depth {depth} bytes, SP down to {results['stack_low']}")
+
+        if results["problems"]:
+            lines += ["", "incomplete"] + [f"  {line}" for line in results["problems"]]
+
+        return "\n".join(lines)
+
+
+def meet(old, new):
+    """What two states agree on"""
+    regs = tuple(x if x == y else None for x, y in zip(old[0], new[0]))
+    delta = old[1] if old[1] == new[1] else None
+    return regs, delta
+
+
+def set_register(regs, reg, value):
+    if reg < SP:
+        regs[reg] = value
+
+
+def fold(ins, regs, a, b):
+    """Run an ALU instruction on the known register values with the CPU's
+    own ALU, the result is unknown unless its inputs are"""
+    reads = [a, b] if ins.operands == "rr" else [a]
+    value = None
+    if all(reg < SP and regs[reg] is not None for reg in reads) and not (
+            ins.name in ("DIV", "MOD") and regs[b] == 0):
+        scratch = SimpleNamespace(registers=bytearray(v or 0 for v in regs + [0]), PC=0)
+        alu.TABLE[ins.opcode](scratch, a, b)
+        value = scratch.registers[a]
+    set_register(regs, a, value)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog=argv[0], description="Static analysis of an LS-8 program")
+    parser.add_argument("file_name", help="the .ls8, .ls8b or .asm program")
+    parser.add_argument("--json", metavar="FILE",
+                        help="write the results to FILE as JSON, - for stdout")
+    args = parser.parse_args(argv[1:])
+
+    from cpu import CPU
+    cpu = CPU()
+    cpu.load(args.file_name)
+    analysis = Analysis(cpu)
+
+    if args.json == "-":
+        print(analysis.to_json())
+    else:
+        print(analysis.report())
+        if args.json:
+            with open(args.json, "w") as fp:
+                fp.write(analysis.to_json())
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
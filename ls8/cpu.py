@@ -1,10 +1,25 @@
 """CPU functionality."""
 
+import copy
+import queue
 import sys
 import time
-import keyboard
 import helpers as hp
 import handlers as hd
+import alu
+import image
+import fusion
+import sourcemap
+from devices import ConsoleOutput, ScriptedInput
+from faults import Fault, InstructionFault
+from jit import MAX_BLOCK_LENGTH, BlockCompiler
+
+# how many instructions run between two looks at the clock
+TIMER_CHECK_INTERVAL = 1000
+
+# how far back a write can reach into the decoded records
+FUSED_REACH = fusion.MAX_LENGTH - 1
+CLEAR_RECORDS = [None] * fusion.MAX_LENGTH
 
 
 class CPU:
@@ -12,11 +27,24 @@ class CPU:
 
     def __init__(self):
         """Construct a new CPU."""
-        self.ram = [0] * 256  # initialize the ram with 256 bytes
-        self.registers = [0] * 8  # initialize 8 registers
+        self.ram = bytearray(256)  # initialize the ram with 256 bytes
+        self.registers = bytearray(8)  # initialize 8 8-bit registers
         self.registers[7] = 0xF4  # set R7 to a hex value
         self.halted = False  # CPU not halted yet
-        self.address = 0
+        self.halt_reason = None  # why run() stopped, e.g. "HALT"
+        self.address = 0  # the end of the loaded program
+        # PUSH, CALL and interrupts fault rather than grow the stack down to
+        # stack_guard, loading a program raises it to the program's end;
+        # POP, RET and IRET fault rather than take SP past stack_top
+        self.stack_guard = 0
+        self.stack_top = 0xF4
+        self.symbols = {}  # label -> address, from .ls8b images and source maps
+        self.source_map = None  # a sourcemap.SourceMap for the loaded program
+        self.output = ConsoleOutput()  # where PRN, PRA and HLT write to
+        self.input = None  # scripted key presses, see devices.ScriptedInput
+        self.key_presses = None  # the keyboard hook's queue, see run()
+        self.recorder = None  # logs timer ticks and key presses, see replay.py
+        self.replay = None  # delivers logged ones instead of timer and input
         self.interrupts_enabled = True
         # internal registers
         self.PC = 0
@@ -25,75 +53,80 @@ class CPU:
         self.FL = 0
         self.IM = 5  # interrupt mask
         self.IS = 6  # interrupt status
+        # pre-decoded instruction cache, one (handler, operand_a, operand_b,
+        # num_operands, instructions) record per RAM address, filled lazily
+        # by decode(). The PC can step up to 3 bytes past the end of RAM,
+        # decode() faults there
+        self.decoded = [None] * (256 + 3)
+        self.fuse = True  # decode common runs as superinstructions
+        self.jit = None  # the basic-block compiler, see use_jit()
+        self.cycles = 0  # instructions executed so far
+        # fire the timer every timer_cycles instructions instead of once
+        # per second of wall-clock time
+        self.timer_cycles = None
+        self.next_tick = None  # when the timer fires next, in seconds or cycles
+        # the instruction count at which run() next polls the timer and the
+        # interrupts, anything that sets a bit in IS or writes IM resets it
+        # to 0
+        self.next_check = 0
+        self.cycle_limit = None  # stop run() at this instruction count
+        self.stop_at = None  # pause step() at this instruction count
+        # poll() fires the timer itself, a scheduler.Session turns this off
+        # and fires it from the event loop instead
+        self.poll_timer = True
 
-        self.branch_table = {  # a table to store the helpers for fast lookup
-            hd.LDI: hd.handle_LDI,
-            hd.PRN: hd.handle_PRN,
-            hd.HALT: hd.handle_HALT,
-            hd.MUL: hd.handle_MUL,
-            hd.ADD: hd.handle_ADD,
-            hd.PUSH: hd.handle_PUSH,
-            hd.POP: hd.handle_POP,
-            hd.JMP: hd.handle_JMP,
-            hd.ST: hd.handle_ST,
-            hd.PRA: hd.handle_PRA,
-            hd.IRET: hd.handle_IRET,
-            hd.LD: hd.handle_LD,
-            hd.CALL: hd.handle_CALL,
-            hd.RET: hd.handle_RET,
-            hd.CMP: hd.handle_CMP,
-            hd.JEQ: hd.handle_JEQ,
-            hd.JNE: hd.handle_JNE,
-            hd.AND: hd.handle_AND,
-            hd.OR: hd.handle_OR,
-            hd.XOR: hd.handle_XOR,
-            hd.NOT: hd.handle_NOT,
-            hd.SHL: hd.handle_SHL,
-            hd.SHR: hd.handle_SHR,
-            hd.MOD: hd.handle_MOD,
-            hd.ADDI: hd.handle_ADDI,
-            hd.INC: hd.handle_INC,
-            hd.DEC: hd.handle_DEC
-        }
+        # a dense table indexed by the raw opcode byte for fast lookup
+        self.branch_table = list(hd.DISPATCH)
+        self.alu_table = alu.TABLE
 
     def load(self, file_name):
-        """Load a program into memory."""
-        hp.write_program_to_ram(self, file_name)
+        """Load a program into memory, .ls8b images are copied in as is and
+        .asm sources are assembled first. A source map next to the program
+        is loaded along with it."""
+        if file_name.endswith(".asm"):
+            with open(file_name) as fp:
+                self.load_source(fp.read())
+            self.source_map.source = file_name
+            return
 
-    def alu(self, op, reg_a, reg_b=None):
-        """ALU operations."""
-        if op == "ADD":
-            self.registers[reg_a] += self.registers[reg_b]
-        elif op == "MUL":
-            self.registers[reg_a] *= self.registers[reg_b]
-        elif op == "CMP":
-            hp.set_FL_kth_bit(self, reg_a, reg_b)
-        elif op == "AND":
-            self.registers[reg_a] = (self.registers[reg_a] & self.registers[reg_b])
-        elif op == "OR":
-            self.registers[reg_a] = (self.registers[reg_a] | self.registers[reg_b])
-        elif op == "XOR":
-            self.registers[reg_a] = (self.registers[reg_a] ^ self.registers[reg_b])
-        elif op == "NOT":
-            self.registers[reg_a] = (~self.registers[reg_a])
-        elif op == "SHL":
-            self.registers[reg_a] = (self.registers[reg_a] << self.registers[reg_b])
-        elif op == "SHR":
-            self.registers[reg_a] = (self.registers[reg_a] >> self.registers[reg_b])
-        elif op == "MOD":
-            if self.registers[reg_b] == 0:
-                print("Can't perform a division over 0, second value can't be 0.")
-                self.halted = True
-            else:
-                self.registers[reg_a] = (self.registers[reg_a] % self.registers[reg_b])
-        elif op == "ADDI":
-            self.registers[reg_a] += reg_b
-        elif op == "INC":
-            self.registers[reg_a] += 1
-        elif op == "DEC":
-            self.registers[reg_a] -= 1
+        if file_name.endswith(".ls8b"):
+            image.load_image_file(self, hp.program_path(file_name))
         else:
-            raise Exception("Unsupported ALU operation")
+            hp.write_program_to_ram(self, file_name)
+
+        source_map = sourcemap.find(hp.program_path(file_name))
+        if source_map is not None:
+            self.source_map = source_map
+            self.symbols.update(source_map.symbols)
+
+    def load_source(self, source):
+        """Assemble LS-8 source in memory and load it, asm.AssemblerError
+        is raised for bad source."""
+        hp.write_source_to_ram(self, source)
+
+    def load_bytes(self, data, address=0):
+        """Copy a run of program bytes into RAM at address in one go"""
+        end = self.write_bytes(data, address)
+        self.address = max(self.address, end)
+        self.stack_guard = max(self.stack_guard, end)
+
+    def write_bytes(self, data, address):
+        """ram_write for a run of bytes, returns the address after them"""
+        end = address + len(data)
+        # a slice assignment would grow RAM instead of failing
+        if end > len(self.ram):
+            raise ValueError(f"{len(data)} bytes at address {address} don't fit in RAM")
+        self.ram[address:end] = data
+        if self.jit is not None:
+            self.jit.invalidate_range(address, end)
+            return end
+        start = max(address - FUSED_REACH, 0)
+        self.decoded[start:end] = [None] * (end - start)
+        return end
+
+    def alu(self, op, reg_a, reg_b=None):
+        """ALU operations, op is the opcode byte of the instruction."""
+        self.alu_table[op](self, reg_a, reg_b)
 
     def ram_read(self, MAR):
         """should accept the address to read and return the value stored there"""
@@ -102,45 +135,269 @@ class CPU:
 
     def ram_write(self, MDR, address):
         """should accept the value to write, and the address to write to"""
-        self.ram[address] = MDR
+        self.ram[address] = MDR & 0xFF  # keep it a byte
+        if self.jit is not None:
+            # compiled blocks never run the decoded records, the debugger
+            # and the profiler drop them all when they turn the JIT off
+            self.jit.invalidate(address)
+            return
+        # a fused run is at most fusion.MAX_LENGTH bytes long, so only the
+        # records decoded at this address or just before it contain the byte
+        if address >= FUSED_REACH:
+            self.decoded[address - FUSED_REACH:address + 1] = CLEAR_RECORDS
+        else:
+            self.decoded[:address + 1] = CLEAR_RECORDS[:address + 1]
+
+    def decode(self, address):
+        """Decode the instruction at address once and cache the record,
+        fusing it with the ones that follow where fusion.py can"""
+        if address >= len(self.ram):
+            raise InstructionFault("PC out of range", address)
+        if self.fuse:
+            record = fusion.fuse(self, address)
+            if record is not None:
+                self.decoded[address] = record
+                return record
+
+        IR = self.ram[address]  # instruction register
+        # the number of bytes the instruction has
+        num_operands = (IR >> 6) + 1
+        handler = self.branch_table[IR]
+        operand_a = self.ram_read(address + 1)
+        if IR in hd.WRITES_REGISTER and operand_a in (self.IM, self.IS):
+            # unmasking or raising an interrupt dispatches it right away
+            handler = hd.rechecking(handler)
+        record = (
+            handler,
+            operand_a,
+            self.ram_read(address + 2),
+            num_operands,
+            1
+        )
+        self.decoded[address] = record
+        return record
+
+    def name(self, address):
+        """address, with its label and source line if the program has a
+        source map, or with its label if it has one"""
+        where = self.source_map and self.source_map.describe(address)
+        if where:
+            return f"{address} {where}"
+        for label, value in self.symbols.items():
+            if value == address:
+                return f"{address} ({label})"
+        return str(address)
+
+    def snapshot(self):
+        """Return the machine state as plain, picklable values: RAM,
+        registers, PC, FL, interrupt state and the output device buffer."""
+        return {
+            "ram": bytes(self.ram),
+            "registers": bytes(self.registers),
+            "PC": self.PC,
+            "IR": self.IR,
+            "FL": self.FL,
+            "halted": self.halted,
+            "halt_reason": self.halt_reason,
+            "address": self.address,
+            "stack_guard": self.stack_guard,
+            "stack_top": self.stack_top,
+            "symbols": dict(self.symbols),
+            "interrupts_enabled": self.interrupts_enabled,
+            "cycles": self.cycles,
+            "timer_cycles": self.timer_cycles,
+            "next_tick": self.next_tick,
+            "output": self.output.snapshot(),
+        }
+
+    def restore(self, state):
+        """Put the machine back into a state returned by snapshot()"""
+        self.ram[:] = state["ram"]
+        self.registers[:] = state["registers"]
+        self.PC = state["PC"]
+        self.IR = state["IR"]
+        self.FL = state["FL"]
+        self.halted = state["halted"]
+        self.halt_reason = state["halt_reason"]
+        self.address = state["address"]
+        self.stack_guard = state["stack_guard"]
+        self.stack_top = state["stack_top"]
+        self.symbols = dict(state["symbols"])
+        self.interrupts_enabled = state["interrupts_enabled"]
+        self.cycles = state["cycles"]
+        self.timer_cycles = state["timer_cycles"]
+        self.next_tick = state["next_tick"]
+        self.next_check = 0
+        self.output.restore(state["output"])
+        # all of RAM may have changed
+        self.decoded[:] = [None] * len(self.decoded)
+        if self.jit is not None:
+            self.jit = BlockCompiler(self)
+
+    def fork(self, state=None):
+        """Return a new CPU started from state, or from this CPU's current
+        state, without loading the program again. It gets its own copy of
+        the output device and the JIT when this CPU uses one."""
+        if state is None:
+            state = self.snapshot()
+        cpu = CPU()
+        cpu.output = copy.copy(self.output)
+        cpu.source_map = self.source_map
+        if self.jit is not None:
+            cpu.use_jit()
+        cpu.restore(state)
+        return cpu
+
+    def use_jit(self):
+        """Run the program as compiled basic blocks instead of one
+        instruction at a time through the branch_table"""
+        self.jit = BlockCompiler(self)
 
     def handle_keyboard_interrupt(self, k_e):
         hp.run_keyboard_interrupt(self, k_e)
 
-    def run(self):
-        """Run the CPU."""
-        keyboard.on_press(self.handle_keyboard_interrupt)
-
-        start_time = time.time()
-        while not self.halted:
-            elapsed_time = time.time() - start_time
-            if elapsed_time >= 1:
-                hp.run_timer_interrupt(self)
-                start_time = time.time()
-
-            if self.interrupts_enabled:
-                masked_interrupts = self.registers[self.IM] & self.registers[self.IS]
-                for i in range(8):
-                    interrupt_happend = ((masked_interrupts >> i) & 1) == 1
-                    if interrupt_happend:
-                        # disable further interrupts
-                        self.interrupts_enabled = False
-                        # clear the bit#0 in the IS register
-                        hp.clear_bit(self, i)
-                        # store the state of the cpu
-                        hp.stack_cpu_state(self)
-                        # set PC to the interrupt handler address
-                        self.PC = self.ram_read(248 + i)
+    def poll(self, cycles):
+        """Fire the timer if it is due and dispatch pending interrupts"""
+        self.cycles = cycles  # the count events are recorded at
+        if self.cycle_limit is not None and cycles >= self.cycle_limit:
+            self.halted = True
+            self.halt_reason = "cycle limit"
+            return
+
+        if self.replay is not None:
+            # recorded events only, no clock and no input
+            next_event = self.replay.deliver(self, cycles)
+            self.next_check = cycles + TIMER_CHECK_INTERVAL
+            if next_event is not None:
+                self.next_check = min(self.next_check, next_event)
+        else:
+            # the next scripted key once the last one was handled
+            if (self.input is not None and self.interrupts_enabled
+                    and not self.registers[self.IS] & 2):
+                key = self.input.read_key()
+                if key is not None:
+                    hp.run_key_interrupt(self, key)
+
+            if not self.poll_timer:
+                self.next_check = cycles + TIMER_CHECK_INTERVAL
+            elif self.timer_cycles is None:
+                now = time.time()
+                if now >= self.next_tick:
+                    self.next_tick = now + 1
+                    hp.run_timer_interrupt(self)
+                self.next_check = cycles + TIMER_CHECK_INTERVAL
+            else:
+                if cycles >= self.next_tick:
+                    self.next_tick = cycles + self.timer_cycles
+                    hp.run_timer_interrupt(self)
+                self.next_check = min(cycles + TIMER_CHECK_INTERVAL, self.next_tick)
+
+        if self.cycle_limit is not None:
+            self.next_check = min(self.next_check, self.cycle_limit)
+        if self.stop_at is not None:
+            self.next_check = min(self.next_check, self.stop_at)
+
+        if self.interrupts_enabled:
+            hp.dispatch_interrupt(self)
+
+    def run(self, max_cycles=None, interactive=True):
+        """Run the CPU, for at most max_cycles instructions if given.
+        Key presses only reach the program when interactive, headless
+        runs get theirs from self.input if set."""
+        if interactive:
+            # hooks the keyboard globally, which needs root on Linux
+            import keyboard
+            # the hook queues every key press, they reach the program
+            # unless its input is scripted already
+            if self.key_presses is None:
+                self.key_presses = queue.Queue()
+            if self.input is None:
+                self.input = ScriptedInput(self.key_presses)
+            keyboard.on_press(self.handle_keyboard_interrupt)
+
+        self.cycle_limit = None if max_cycles is None else self.cycles + max_cycles
+        self.start_timer()
+        try:
+            self.execute()
+        finally:
+            self.output.flush()
+
+    def step(self, budget):
+        """Run at most budget instructions. Returns None if the program can go on, otherwise why it
+        stopped ("HALT", "cycle limit", ...). Faults are raised."""
+        if self.next_tick is None:
+            self.start_timer()
+        try:
+            self.execute(self.cycles + budget)
+        finally:
+            self.output.flush()
+        return self.halt_reason if self.halted else None
+
+    def start_timer(self):
+        """Fire the timer a second or timer_cycles instructions from now"""
+        if self.timer_cycles is None:
+            self.next_tick = time.time() + 1
+        else:
+            self.next_tick = self.cycles + self.timer_cycles
+
+    def execute(self, stop=None):
+        """Execute instructions until the CPU halts or, if given, the
+        instruction count reaches stop. A Fault halts the CPU and is raised
+        on."""
+        decoded = self.decoded
+        jit = self.jit
+        if jit is not None:
+            blocks = jit.blocks
+        cycles = self.cycles
+        self.stop_at = stop
+        # the count no compiled block may run past
+        last = min((limit for limit in (self.cycle_limit, stop) if limit is not None),
+                   default=float("inf"))
+        self.next_check = cycles
+        try:
+            while not self.halted:
+                if cycles >= self.next_check:
+                    if stop is not None and cycles >= stop:
                         break
+                    if jit is not None:
+                        jit.ran = 0  # an interrupt fault isn't a block's
+                    self.poll(cycles)
+                    continue
+
+                if jit is not None:
+                    if cycles + MAX_BLOCK_LENGTH <= last:
+                        # run a whole compiled block at once
+                        block = blocks[self.PC] or jit.compile(self.PC)
+                        cycles += block(self, cycles)
+                        continue
+                    # a block could run past the limit, interpret the last
+                    # instructions, decoded afresh as the JIT doesn't keep
+                    # decoded up to date
+                    decoded[self.PC] = None
 
-            if self.address == self.registers[self.SP]:
-                print("\n*** THE STACK IS FULL. EXITING... TO AVOID OVERFLOWING ***\n")
-                return
-            else:   # keep executing instructions as usual
-                IR = self.ram_read(self.PC)  # instruction register
-                # the number of bytes the instruction has
-                num_operands = (IR >> 6) + 1
-                operand_a = self.ram_read(self.PC + 1)
-                operand_b = self.ram_read(self.PC + 2)
-                # Access and call the right function in the branch_table
-                self.branch_table[IR](self, operand_a, operand_b, num_operands)
+                # keep executing instructions as usual, reusing the decoded
+                # record and only decoding on a cache miss
+                handler, operand_a, operand_b, num_operands, count = (
+                    decoded[self.PC] or self.decode(self.PC)
+                )
+                if count == 1:
+                    handler(self, operand_a, operand_b, num_operands)
+                    cycles += 1
+                elif cycles + count <= self.next_check:
+                    # a fused run, it returns how many instructions it ran
+                    cycles += handler(self, operand_a, operand_b, num_operands)
+                else:
+                    # too close to the next poll, run its first instruction alone
+                    self.branch_table[self.ram[self.PC]](
+                        self, operand_a, operand_b, num_operands)
+                    cycles += 1
+        except Fault as fault:
+            if jit is not None:
+                cycles += jit.ran  # the block's instructions before the fault
+                jit.ran = 0
+            # stop here, the caller decides what a fault means
+            self.halted = True
+            self.halt_reason = fault.reason
+            raise
+        finally:
+            self.cycles = cycles
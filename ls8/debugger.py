@@ -0,0 +1,382 @@
+"""Breakpoints, watchpoints and register conditions for a CPU.
+
+    debugger = Debugger(cpu)
+    debugger.add_breakpoint(0x10)
+    debugger.cont()       # "breakpoint"
+    debugger.step()
+    debugger.detach()
+
+A breakpoint costs nothing until it is hit: the decoded record at its
+address is swapped for a trap that stops the run before the instruction,
+every other address keeps its usual record, superinstructions included
+(only a fused run over a breakpoint is split). Watchpoints wrap ram_write
+and register conditions wrap the branch_table entries, each only while
+any are set, and they turn the superinstructions off, which go through
+neither. Like with the Profiler the block compiler is off while a
+Debugger is attached.
+
+The program runs through CPU.step(), so key presses come from cpu.input
+or a replay. repl() reads debugger commands from stdin, "help" lists them.
+"""
+
+import operator
+import sys
+import fusion
+import isa
+from faults import Fault
+from jit import BlockCompiler
+
+# the halt_reasons the debugger stops a run with, any other one is the
+# program's
+STOPS = ("breakpoint", "watchpoint", "condition")
+
+# instructions per CPU.step() while continuing
+SLICE = 10000
+
+COMPARISONS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    ">": operator.gt,
+    "<=": operator.le,
+    ">=": operator.ge,
+}
+
+HELP = """\
+break ADDR          stop before the instruction at ADDR, a number or a label
+delete ADDR         remove the breakpoint at ADDR
+watch FIRST [LAST]  stop after a write to RAM between FIRST and LAST
+unwatch FIRST       remove the watchpoint starting at FIRST
+cond Rn             stop when Rn changes
+cond Rn OP VALUE    stop when Rn OP VALUE holds, OP is one of == != < > <= >=
+uncond N            remove condition N
+step [N]            run N instructions, 1 by default
+continue [N]        run until something stops the program, at most N instructions
+regs                show the registers, PC and FL
+mem ADDR [COUNT]    show COUNT bytes of RAM from ADDR
+info                list the breakpoints, watchpoints and conditions
+quit"""
+
+# short forms of the commands
+ALIASES = {"b": "break", "d": "delete", "w": "watch", "s": "step",
+           "c": "continue", "r": "regs", "m": "mem", "i": "info", "q": "quit"}
+
+
+class Debugger:
+    """Stops a CPU at breakpoints, watched RAM writes and register
+    conditions."""
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.breakpoints = set()  # addresses
+        self.watchpoints = []  # (first, last) RAM ranges, both included
+        self.conditions = []  # (description, predicate taking the cpu)
+        self.hit = None  # what stopped the last run, e.g. "breakpoint at 12"
+        self.passing = None  # the breakpoint a resumed run goes through once
+
+        # compiled blocks run neither decoded records nor branch_table entries
+        self.used_jit = cpu.jit is not None
+        cpu.jit = None
+
+        self.fused = cpu.fuse
+        self.branch_table = cpu.branch_table
+        self.cpu_decode = cpu.decode
+        self.cpu_ram_write = cpu.ram_write
+        self.cpu_write_bytes = cpu.write_bytes
+        cpu.decode = self.decode
+        cpu.decoded[:] = [None] * len(cpu.decoded)
+
+    def detach(self):
+        """Take every hook out of the CPU again"""
+        cpu = self.cpu
+        for name in ("decode", "ram_write", "write_bytes"):
+            vars(cpu).pop(name, None)
+        cpu.branch_table = self.branch_table
+        cpu.fuse = self.fused
+        if cpu.halt_reason in STOPS:
+            cpu.halted = False
+            cpu.halt_reason = None
+        cpu.decoded[:] = [None] * len(cpu.decoded)
+        if self.used_jit:
+            cpu.jit = BlockCompiler(cpu)
+
+    def add_breakpoint(self, address):
+        self.breakpoints.add(address)
+        self.drop(address)
+
+    def remove_breakpoint(self, address):
+        self.breakpoints.discard(address)
+        self.drop(address)
+
+    def add_watchpoint(self, first, last=None):
+        """Stop after any write to RAM from first to last"""
+        self.watchpoints.append((first, first if last is None else last))
+        self.update()
+
+    def remove_watchpoint(self, first):
+        self.watchpoints = [watch for watch in self.watchpoints if watch[0] != first]
+        self.update()
+
+    def add_condition(self, predicate, description):
+        """Stop after the instruction that makes predicate(cpu) true"""
+        self.conditions.append((description, predicate))
+        self.update()
+
+    def remove_condition(self, index):
+        del self.conditions[index]
+        self.update()
+
+    def watch_register(self, reg):
+        """Stop when register reg changes"""
+        last = [self.cpu.registers[reg]]
+
+        def changed(cpu):
+            value = cpu.registers[reg]
+            if value == last[0]:
+                return False
+            last[0] = value
+            return True
+        self.add_condition(changed, f"R{reg} changed")
+
+    def break_when(self, reg, op, value):
+        """Stop when register reg compares to value with op, a key of
+        COMPARISONS"""
+        if op not in COMPARISONS:
+            raise ValueError(f"unknown comparison {op}")
+        compare = COMPARISONS[op]
+        self.add_condition(lambda cpu: compare(cpu.registers[reg], value),
+                           f"R{reg} {op} {value}")
+
+    def drop(self, address):
+        """Drop the decoded records that run the instruction at address,
+        fused ones start up to fusion.MAX_LENGTH - 1 bytes before it"""
+        start = max(address - fusion.MAX_LENGTH + 1, 0)
+        self.cpu.decoded[start:address + 1] = [None] * (address + 1 - start)
+
+    def update(self):
+        """Hook ram_write and the branch_table for the watchpoints and the
+        conditions set, or unhook them when there are none"""
+        cpu = self.cpu
+        if self.watchpoints:
+            cpu.ram_write = self.ram_write
+            cpu.write_bytes = self.write_bytes
+        else:
+            vars(cpu).pop("ram_write", None)
+            vars(cpu).pop("write_bytes", None)
+
+        if self.conditions:
+            cpu.branch_table = [self.wrap(handler) for handler in self.branch_table]
+        else:
+            cpu.branch_table = self.branch_table
+
+        cpu.fuse = self.fused and not self.watchpoints and not self.conditions
+        cpu.decoded[:] = [None] * len(cpu.decoded)
+
+    def decode(self, address):
+        """CPU.decode() with a trap at every breakpoint, and no fused run
+        over one"""
+        if address in self.breakpoints:
+            # a count of 0 as the trap runs no instruction when it stops
+            record = (self.trap,) + self.plain_decode(address)[1:4] + (0,)
+            self.cpu.decoded[address] = record
+            return record
+
+        record = self.cpu_decode(address)
+        if record[4] > 1:
+            end = address + fusion.MAX_LENGTH
+            if any(address < at < end for at in self.breakpoints):
+                record = self.plain_decode(address)
+        return record
+
+    def plain_decode(self, address):
+        cpu = self.cpu
+        fuse, cpu.fuse = cpu.fuse, False
+        record = self.cpu_decode(address)
+        cpu.fuse = fuse
+        return record
+
+    def trap(self, cpu, operand_a, operand_b, num_operands):
+        """The record of every breakpoint: stops before the instruction,
+        or runs it when resuming from this breakpoint"""
+        if self.passing == cpu.PC:
+            self.passing = None
+            cpu.branch_table[cpu.ram[cpu.PC]](cpu, operand_a, operand_b, num_operands)
+            return 1
+        self.stop("breakpoint", f"breakpoint at {cpu.name(cpu.PC)}")
+        return 0
+
+    def ram_write(self, MDR, address):
+        old = self.cpu.ram[address]
+        self.cpu_ram_write(MDR, address)
+        if any(first <= address <= last for first, last in self.watchpoints):
+            self.stop("watchpoint", f"watchpoint: ram[{address}] {old} -> {MDR & 0xFF} "
+                                    f"by {self.cpu.name(self.cpu.PC)}")
+
+    def write_bytes(self, data, address):
+        end = self.cpu_write_bytes(data, address)
+        if any(first < end and address <= last for first, last in self.watchpoints):
+            self.stop("watchpoint", f"watchpoint: ram[{address}:{end}] written "
+                                    f"by {self.cpu.name(self.cpu.PC)}")
+        return end
+
+    def wrap(self, handler):
+        """Return handler checking the conditions after it ran"""
+        conditions = self.conditions
+
+        def checked(cpu, operand_a, operand_b, num_operands):
+            PC = cpu.PC
+            handler(cpu, operand_a, operand_b, num_operands)
+            for description, predicate in conditions:
+                if predicate(cpu):
+                    self.stop("condition", f"{description} after {cpu.name(PC)}")
+                    break
+        return checked
+
+    def stop(self, reason, hit):
+        """Halt the run, run loop and CPU.step() return on halted"""
+        cpu = self.cpu
+        if not cpu.halted:
+            cpu.halted = True
+            cpu.halt_reason = reason
+            self.hit = hit
+
+    def resume(self):
+        """Undo the last stop so the program can go on"""
+        cpu = self.cpu
+        if cpu.halt_reason in STOPS:
+            cpu.halted = False
+            cpu.halt_reason = None
+        self.hit = None
+        self.passing = cpu.PC if cpu.PC in self.breakpoints else None
+
+    def step(self, count=1):
+        """Run count instructions, returns None, or why the run stopped
+        before ("breakpoint", "HALT", ...). Faults are raised."""
+        for _ in range(count):
+            self.resume()
+            status = self.cpu.step(1)
+            if status is not None:
+                return status
+        return None
+
+    def cont(self, max_cycles=None):
+        """Run until a breakpoint, watchpoint or condition stops the program
+        or it halts, returns why. Faults are raised."""
+        cpu = self.cpu
+        self.resume()
+        limit = None if max_cycles is None else cpu.cycles + max_cycles
+        while True:
+            budget = SLICE if limit is None else min(SLICE, limit - cpu.cycles)
+            if budget <= 0:
+                return "cycle limit"
+            status = cpu.step(budget)
+            if status is not None:
+                return status
+
+    def address(self, text):
+        """Parse an address, a number in any base python reads or a label"""
+        label = text.upper()  # as the assembler has them
+        if label in self.cpu.symbols:
+            return self.cpu.symbols[label]
+        return int(text, 0)
+
+    def where(self):
+        """The current PC and the instruction there, as it is in the source
+        if there is a source map"""
+        cpu = self.cpu
+        entry = cpu.source_map and cpu.source_map.entry(cpu.PC)
+        if entry:
+            text = entry["text"]
+        elif cpu.PC < len(cpu.ram):
+            text = isa.disassemble(cpu.ram, cpu.PC)
+        else:
+            text = "past the end of RAM"
+        return f"{cpu.name(cpu.PC)}: {text}"
+
+    def command(self, command, args, out):
+        """Run one REPL command, returns False for quit"""
+        cpu = self.cpu
+        command = ALIASES.get(command, command)
+        if command == "quit":
+            return False
+
+        if command == "help":
+            print(HELP, file=out)
+        elif command == "break":
+            self.add_breakpoint(self.address(args[0]))
+        elif command == "delete":
+            self.remove_breakpoint(self.address(args[0]))
+        elif command == "watch":
+            last = self.address(args[1]) if len(args) > 1 else None
+            self.add_watchpoint(self.address(args[0]), last)
+        elif command == "unwatch":
+            self.remove_watchpoint(self.address(args[0]))
+        elif command == "cond":
+            reg = register(args[0])
+            if len(args) == 1:
+                self.watch_register(reg)
+            else:
+                self.break_when(reg, args[1], int(args[2], 0))
+        elif command == "uncond":
+            self.remove_condition(int(args[0]))
+        elif command in ("step", "continue"):
+            count = int(args[0], 0) if args else None
+            try:
+                if command == "step":
+                    status = self.step(count or 1)
+                else:
+                    status = self.cont(count)
+            except Fault as fault:
+                status = fault.reason
+                print(f"fault: {fault}", file=out)
+            cpu.output.flush()
+            if status in STOPS:
+                print(self.hit, file=out)
+            elif status is not None:
+                print(f"stopped: {status}", file=out)
+            print(self.where(), file=out)
+        elif command == "regs":
+            registers = " ".join(f"R{i}={value}" for i, value in enumerate(cpu.registers))
+            print(f"{registers} PC={cpu.PC} FL={cpu.FL:03b} cycles={cpu.cycles}", file=out)
+        elif command == "mem":
+            first = self.address(args[0])
+            count = int(args[1], 0) if len(args) > 1 else 16
+            data = cpu.ram[first:first + count]
+            print(f"{first}: " + " ".join(f"{byte:02x}" for byte in data), file=out)
+        elif command == "info":
+            for address in sorted(self.breakpoints):
+                print(f"break {cpu.name(address)}", file=out)
+            for first, last in self.watchpoints:
+                print(f"watch {first}..{last}", file=out)
+            for index, (description, predicate) in enumerate(self.conditions):
+                print(f"cond {index}: {description}", file=out)
+        else:
+            print(f"unknown command {command!r}, try help", file=out)
+        return True
+
+    def repl(self, stdin=sys.stdin, out=sys.stdout):
+        """Read commands from stdin until quit or the end of the input"""
+        print(self.where(), file=out)
+        while True:
+            out.write("(ls8) ")
+            out.flush()
+            line = stdin.readline()
+            if not line:
+                break
+            words = line.split()
+            if not words:
+                continue
+            try:
+                if not self.command(words[0], words[1:], out):
+                    break
+            except IndexError:
+                print(f"error: {words[0]} is missing an argument", file=out)
+            except ValueError as error:
+                print(f"error: {error}", file=out)
+
+
+def register(text):
+    """Parse a register name, R0 to R7"""
+    if len(text) != 2 or text[0] not in "Rr" or text[1] not in "01234567":
+        raise ValueError(f"not a register: {text}")
+    return int(text[1])
@@ -0,0 +1,153 @@
+"""Output devices PRN, PRA and HLT write to, and scripted input.
+
+CPU.output is one of these. ConsoleOutput is the boxed console output the
+emulator always had, RawOutput writes bare values through a buffer and
+CaptureOutput keeps them in memory for tests and batch runs.
+
+CPU.input can be a ScriptedInput, which feeds key presses to headless runs
+instead of the keyboard.
+"""
+
+import io
+import queue
+import sys
+
+
+class ConsoleOutput:
+    """Every PRN and HLT in a box, every PRA character on its own line."""
+
+    def number(self, reg_num, value):
+        print(" -------------------")
+        print(f"| Register_{reg_num} |  {value} |")
+        print(" -------------------")
+
+    def char(self, value):
+        print(chr(value))
+
+    def halt(self):
+        print(" -------------------")
+        print("|    *** HALT ***   |")
+        print(" -------------------")
+
+    def message(self, text):
+        print(text)
+
+    def flush(self):
+        pass
+
+    def snapshot(self):
+        return None  # nothing buffered
+
+    def restore(self, state):
+        pass
+
+
+class RawOutput:
+    """PRN writes the bare number and a newline, PRA the bare character.
+    Writes are buffered until HLT or until buffer_size characters are
+    waiting."""
+
+    def __init__(self, stream=None, buffer_size=8192):
+        self.stream = stream or sys.stdout
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def number(self, reg_num, value):
+        self.write(f"{value}\n")
+
+    def char(self, value):
+        self.write(chr(value))
+
+    def halt(self):
+        self.flush()
+
+    def message(self, text):
+        self.write(f"{text}\n")
+
+    def flush(self):
+        if self.buffer:
+            self.stream.write("".join(self.buffer))
+            self.buffer.clear()
+            self.buffered = 0
+        self.stream.flush()
+
+    def snapshot(self):
+        """Return what is still waiting in the buffer"""
+        return "".join(self.buffer)
+
+    def restore(self, state):
+        # a new list, a copy.copy of this device must not share it
+        self.buffer = [state] if state else []
+        self.buffered = len(state)
+
+
+class CaptureOutput(RawOutput):
+    """Raw output kept in memory, read it back with getvalue()."""
+
+    def __init__(self):
+        super().__init__(io.StringIO())
+
+    def write(self, text):
+        # already in memory, nothing to buffer
+        self.stream.write(text)
+
+    def getvalue(self):
+        return self.stream.getvalue()
+
+    def snapshot(self):
+        return self.stream.getvalue()
+
+    def restore(self, state):
+        # a new stream, a copy.copy of this device must not share it
+        self.stream = io.StringIO()
+        self.stream.write(state)
+
+
+class ScriptedInput:
+    """Key presses read from a file or pipe, taken from a queue.Queue, or
+    from any iterable of characters or key codes such as a string.
+
+    Each key raises IS bit 1 and is written to 0xF4, just like a real key
+    press, once the program has handled the previous one. A file or
+    pipe is read a character at a time, so a pipe holds the run up until
+    its next key arrives; a queue never does, an empty one just means no
+    key yet."""
+
+    def __init__(self, source):
+        self.source = source
+        if isinstance(source, queue.Queue):
+            self.read = self.read_queue
+        elif hasattr(source, "read"):
+            self.read = self.read_stream
+        else:
+            self.keys = iter(source)
+            self.read = self.read_iterable
+
+    def read_key(self):
+        """Return the next key code, or None if there is none (yet)"""
+        key = self.read()
+        if key is None:
+            return None
+        return (ord(key) if isinstance(key, str) else key) & 0xFF
+
+    def read_stream(self):
+        key = self.source.read(1)
+        if not key:
+            return None  # end of the file
+        return key if isinstance(key, str) else key[0]
+
+    def read_queue(self):
+        try:
+            return self.source.get_nowait()
+        except queue.Empty:
+            return None
+
+    def read_iterable(self):
+        return next(self.keys, None)
@@ -0,0 +1,41 @@
+"""Faults the CPU raises for a broken program instead of exiting.
+
+run() and step() stop at a fault with halted set and halt_reason naming
+it, then let it propagate so the caller (the command line, a batch runner,
+a scheduler) decides what to do. The host process keeps running.
+"""
+
+
+class Fault(Exception):
+    """Base class of the faults, reason is what halt_reason is set to."""
+
+    reason = "fault"
+
+    def __init__(self, message, PC):
+        super().__init__(message)
+        self.PC = PC  # the address of the faulting instruction
+
+
+class StackFault(Fault):
+    """A PUSH, CALL or interrupt would grow the stack down to the guard
+    ("stack overflow"), or a POP, RET or IRET would take more off it than
+    there is ("stack underflow")."""
+
+    def __init__(self, reason, PC, SP):
+        super().__init__(f"{reason} at address {PC}, SP is {SP}", PC)
+        self.reason = reason
+        self.SP = SP
+
+
+class InstructionFault(Fault):
+    """The PC got to a byte that is no instruction ("unknown instruction")
+    or ran off the end of RAM ("PC out of range")."""
+
+    def __init__(self, reason, PC, IR=None):
+        if IR is None:
+            message = f"{reason} at address {PC}"
+        else:
+            message = f"{reason} {IR:08b} at address {PC}"
+        super().__init__(message, PC)
+        self.reason = reason
+        self.IR = IR  # the byte that isn't an instruction
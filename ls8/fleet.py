@@ -0,0 +1,125 @@
+"""Run batches of .ls8 programs on a pool of worker processes.
+
+A batch is either a directory, whose .ls8 files are each run once, or a
+manifest file with one JSON job per line:
+
+    {"program": "examples/mult.ls8", "ram": {"2": 9}, "max_cycles": 10000}
+
+"ram" and "registers" map addresses / register numbers to the values set
+after the program is loaded, "input" is a string of key presses. Relative
+program paths are taken from the manifest's directory. Every finished job
+is written as a line of JSON.
+"""
+
+import contextlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import cfg
+from cpu import CPU
+from devices import CaptureOutput, ScriptedInput
+from faults import Fault
+
+# program -> (CPU.snapshot() taken right after loading it, its source map),
+# kept per worker process so jobs running the same program only load it once
+loaded = {}
+
+# program -> the block starts cfg.Analysis found in it, for precompiling
+analyzed = {}
+
+
+def read_jobs(source):
+    """Return the jobs of a batch directory or manifest"""
+    if os.path.isdir(source):
+        return [
+            {"program": os.path.join(source, name)}
+            for name in sorted(os.listdir(source))
+            if name.endswith(".ls8")
+        ]
+
+    jobs = []
+    base = os.path.dirname(source)
+    with open(source) as fp:
+        for line in fp:
+            if line.strip():
+                job = json.loads(line)
+                job["program"] = os.path.join(base, job["program"])
+                jobs.append(job)
+    return jobs
+
+
+def run_job(job, max_cycles=None, use_jit=False, precompile=False):
+    """Run one job in this process and return its result. precompile
+    compiles the blocks a static analysis of the program finds before
+    it runs, it needs use_jit."""
+    cpu = CPU()
+    if use_jit:
+        cpu.use_jit()
+
+    cpu.output = CaptureOutput()
+    start = time.perf_counter()
+    fault = None
+    try:
+        # anything still printed ends up in the captured output too
+        with contextlib.redirect_stdout(cpu.output.stream):
+            if job["program"] not in loaded:
+                cpu.load(job["program"])
+                loaded[job["program"]] = (cpu.snapshot(), cpu.source_map)
+            else:
+                state, cpu.source_map = loaded[job["program"]]
+                cpu.restore(state)
+            if precompile:
+                if job["program"] not in analyzed:
+                    analyzed[job["program"]] = cfg.Analysis(cpu).block_starts()
+                cpu.jit.precompile(analyzed[job["program"]])
+            for address, value in job.get("ram", {}).items():
+                cpu.ram_write(value, int(address, 0))
+            for reg_num, value in job.get("registers", {}).items():
+                cpu.registers[int(reg_num)] = value & 0xFF
+            if "input" in job:
+                cpu.input = ScriptedInput(job["input"])
+            cpu.run(job.get("max_cycles", max_cycles), interactive=False)
+        halt_reason = cpu.halt_reason
+    except Fault as e:
+        halt_reason = e.reason
+        fault = str(e)
+        where = cpu.source_map and cpu.source_map.describe(e.PC)
+        if where:
+            fault += f" ({where})"
+    except Exception as e:
+        # a program that can't be loaded, or a bug in the emulator
+        halt_reason = f"error: {type(e).__name__}: {e}"
+
+    return {
+        "program": job["program"],
+        "output": cpu.output.getvalue(),
+        "registers": list(cpu.registers),
+        "PC": cpu.PC,
+        "FL": cpu.FL,
+        "cycles": cpu.cycles,
+        "halt_reason": halt_reason,
+        "fault": fault,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def run_batch(source, out, workers=None, max_cycles=None, use_jit=False,
+              precompile=False):
+    """Run every job of a batch on a process pool, writing each result to
+    out as a JSON line as soon as it finishes. Returns how many failed."""
+    jobs = read_jobs(source)
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(run_job, job, max_cycles, use_jit, precompile): index
+            for index, job in enumerate(jobs)
+        }
+        for future in as_completed(futures):
+            result = future.result()
+            result["job"] = futures[future]
+            if result["halt_reason"] != "HALT":
+                failed += 1
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+    return failed
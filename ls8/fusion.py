@@ -0,0 +1,185 @@
+"""Superinstructions for the decoded interpreter.
+
+CPU.decode() asks fuse() whether the instructions at an address start one
+of the runs the assembler emits all the time:
+
+    LDI Rx,label  + JMP/CALL/Jcc Rx
+    LDI Rx,label  + CMP + Jcc Rx
+    CMP           + Jcc
+    CMP           + LDI Rx,label + Jcc Rx
+    INC/DEC       + CMP + Jcc
+    PUSH/POP      + PUSH/POP
+
+where Jcc is any conditional jump in isa.CONDITIONS (JEQ, JNE, JGT, ...),
+and if so returns one record that runs the whole run in a single dispatch.
+A fused handler returns how many instructions it ran. The run loop never
+starts a fused run that would cross its next poll, so timers, interrupts
+and cycle limits land on exactly the same instruction as without fusion.
+A stack operation that would fault or write into the run itself stops
+after the instructions done so far and leaves the rest to the plain
+handlers.
+"""
+
+import handlers as hd
+import isa
+
+# the longest fused run in bytes, LDI + CMP + Jcc; ram_write and load_bytes
+# drop the records decoded this far back
+MAX_LENGTH = 8
+
+SP = 7  # the stack pointer register
+
+# no fused run writes these: SP moves are checked by the stack handlers,
+# and writes to IM (R5) and IS (R6) must dispatch interrupts right away
+KEPT = (5, 6, SP)
+
+CONDITIONS = isa.CONDITIONS
+
+
+def fuse(cpu, address):
+    """Return a fused record (handler, operand_a, operand_b, num_operands,
+    instructions) for the run starting at address, or None. The operands
+    are the first instruction's, so it can still be run on its own."""
+    ram = cpu.ram
+    # three instructions of up to 4 bytes are looked at
+    if address + 12 > len(ram):
+        return None
+
+    op, a, b = ram[address], ram[address + 1], ram[address + 2]
+    n = (op >> 6) + 1
+    second = address + n
+    op1, a1, b1 = ram[second], ram[second + 1], ram[second + 2]
+    third = second + (op1 >> 6) + 1
+    op2, a2 = ram[third], ram[third + 1]
+    after = third + (op2 >> 6) + 1
+
+    if op == hd.LDI and a not in KEPT:
+        if (op1 in (hd.JMP, hd.CALL) or op1 in CONDITIONS) and a1 == a:
+            return (ldi_jump(a, b, op1, third), a, b, n, 2)
+        if op1 == hd.CMP and op2 in CONDITIONS:
+            return (ldi_cmp_jump(a, b, a1, b1, op2, a2, after), a, b, n, 3)
+    elif op == hd.CMP:
+        if op1 in CONDITIONS:
+            return (cmp_jump(a, b, op1, a1, third), a, b, n, 2)
+        if op1 == hd.LDI and a1 not in KEPT + (a, b) and op2 in CONDITIONS:
+            return (ldi_cmp_jump(a1, b1, a, b, op2, a2, after), a, b, n, 3)
+    elif op in (hd.INC, hd.DEC) and a not in KEPT:
+        if op1 == hd.CMP and op2 in CONDITIONS:
+            return (step_cmp_jump(op, a, a1, b1, op2, a2, after), a, b, n, 3)
+    elif op in (hd.PUSH, hd.POP) and op1 in (hd.PUSH, hd.POP):
+        if a not in KEPT and a1 not in KEPT:
+            return (stack_pair(address, op, a, op1, a1), a, b, n, 2)
+    return None
+
+
+def ldi_jump(reg, value, op, after):
+    """LDI Rx,value + JMP/CALL/Jcc Rx"""
+    if op == hd.JMP:
+        def fused(cpu, operand_a, operand_b, num_operands):
+            cpu.registers[reg] = value
+            cpu.PC = value
+            return 2
+    elif op == hd.CALL:
+        def fused(cpu, operand_a, operand_b, num_operands):
+            regs = cpu.registers
+            regs[reg] = value
+            if regs[SP] - 1 <= cpu.stack_guard:
+                # leave the stack fault to handle_CALL
+                cpu.PC = after - 2
+                return 1
+            regs[SP] -= 1
+            cpu.ram_write(after, regs[SP])
+            cpu.PC = value
+            return 2
+    else:
+        jumps = isa.jump_table(op)
+
+        def fused(cpu, operand_a, operand_b, num_operands):
+            cpu.registers[reg] = value
+            cpu.PC = value if jumps[cpu.FL] else after
+            return 2
+    return fused
+
+
+def cmp_jump(reg_a, reg_b, op, target, after):
+    """CMP + Jcc"""
+    jumps = isa.jump_table(op)
+
+    def fused(cpu, operand_a, operand_b, num_operands):
+        regs = cpu.registers
+        x, y = regs[reg_a], regs[reg_b]
+        FL = cpu.FL = 1 if x == y else 2 if x > y else 4
+        cpu.PC = regs[target] if jumps[FL] else after
+        return 2
+    return fused
+
+
+def ldi_cmp_jump(reg, value, reg_a, reg_b, op, target, after):
+    """LDI Rx,value + CMP + Jcc, or CMP + LDI + Jcc: LDI doesn't
+    touch FL, so both orders come out the same when the compare doesn't
+    read Rx"""
+    jumps = isa.jump_table(op)
+
+    def fused(cpu, operand_a, operand_b, num_operands):
+        regs = cpu.registers
+        regs[reg] = value
+        x, y = regs[reg_a], regs[reg_b]
+        FL = cpu.FL = 1 if x == y else 2 if x > y else 4
+        cpu.PC = regs[target] if jumps[FL] else after
+        return 3
+    return fused
+
+
+def step_cmp_jump(step_op, reg, reg_a, reg_b, op, target, after):
+    """INC/DEC + CMP + Jcc"""
+    step = 1 if step_op == hd.INC else -1
+    jumps = isa.jump_table(op)
+
+    def fused(cpu, operand_a, operand_b, num_operands):
+        regs = cpu.registers
+        regs[reg] = (regs[reg] + step) & 0xFF
+        x, y = regs[reg_a], regs[reg_b]
+        FL = cpu.FL = 1 if x == y else 2 if x > y else 4
+        cpu.PC = regs[target] if jumps[FL] else after
+        return 3
+    return fused
+
+
+def stack_pair(address, op, reg, op1, reg1):
+    """Two PUSHes and/or POPs, each run only when the plain handler would
+    neither fault nor have its bytes overwritten"""
+    ops = ((op, reg, address), (op1, reg1, address + 2))
+
+    def fused(cpu, operand_a, operand_b, num_operands):
+        regs = cpu.registers
+        for done, (op, reg, at) in enumerate(ops):
+            SP_value = regs[SP]
+            if op == hd.PUSH:
+                if SP_value - 1 <= cpu.stack_guard:
+                    # let handle_PUSH raise the overflow
+                    return bail(cpu, done, op, reg, at)
+                SP_value = regs[SP] = SP_value - 1
+                cpu.ram_write(regs[reg], SP_value)
+                if cpu.decoded[address] is None:
+                    # the push overwrote this very run
+                    cpu.PC = at + 2
+                    return done + 1
+            else:
+                if SP_value >= cpu.stack_top:
+                    # let handle_POP raise the underflow
+                    return bail(cpu, done, op, reg, at)
+                regs[reg] = cpu.ram[SP_value]
+                regs[SP] = SP_value + 1
+        cpu.PC = address + 4
+        return 2
+    return fused
+
+
+def bail(cpu, done, op, reg, at):
+    """Leave a stack pair early, the instruction at at still to run. The
+    first one is run by its plain handler so the run always moves on."""
+    if done == 0:
+        cpu.branch_table[op](cpu, reg, None, 2)
+        return 1
+    cpu.PC = at
+    return done
@@ -1,176 +1,187 @@
-import sys
+import alu
+import isa
+from faults import InstructionFault, StackFault
 
-# CPU instructions binary value
-LDI, PRN, HALT, MUL, ADD, PUSH, POP, JMP, ST, PRA, IRET, LD, CALL, RET, CMP, JEQ, JNE, AND, OR, XOR, NOT, SHL, SHR, MOD, ADDI, INC, DEC = 130, 71, 1, 162, 160, 69, 70, 84, 132, 72, 19, 131, 80, 17, 167, 85, 86, 168, 170, 171, 105, 172, 173, 164, 165, 101, 102
+# CPU instructions binary value, see isa.py
+(LDI, PRN, HALT, MUL, ADD, SUB, DIV, PUSH, POP, JMP, ST, PRA, IRET, LD, CALL,
+ RET, CMP, JEQ, JNE, JGT, JLT, JLE, JGE, AND, OR, XOR, NOT, SHL, SHR, MOD, ADDI,
+ INC, DEC, INT, NOP) = (isa.OPCODES[name] for name in """
+    LDI PRN HLT MUL ADD SUB DIV PUSH POP JMP ST PRA IRET LD CALL
+    RET CMP JEQ JNE JGT JLT JLE JGE AND OR XOR NOT SHL SHR MOD ADDI
+    INC DEC INT NOP""".split())
 
 
-def handle_LDI(self, *args):
-    reg_num, value, num_operands = args[0], args[1], args[2]
+def handle_LDI(self, reg_num, value, num_operands):
     self.registers[reg_num] = value
     self.PC += num_operands
 
 
-def handle_PRN(self, *args):
-    reg_num, num_operands = args[0], args[2]
-    print(" -------------------")
-    print(f"| Register_{reg_num} |  {self.registers[reg_num]} |")
-    print(" -------------------")
+def handle_PRN(self, reg_num, operand_b, num_operands):
+    self.output.number(reg_num, self.registers[reg_num])
     self.PC += num_operands
 
 
-def handle_HALT(self, *args):
-    self.halted, num_operands = True, args[2]
+def handle_HLT(self, operand_a, operand_b, num_operands):
+    self.halted = True
+    self.halt_reason = "HALT"
     self.PC += num_operands
-    print(" -------------------")
-    print("|    *** HALT ***   |")
-    print(" -------------------")
+    self.output.halt()
 
 
-def handle_MUL(self, *args):
-    reg_a, reg_b, num_operands = args[0], args[1], args[2]
-    self.alu("MUL", reg_a, reg_b)
+def handle_PUSH(self, reg_num, operand_b, num_operands):
+    SP = self.registers[self.SP] - 1
+    if SP <= self.stack_guard:
+        raise StackFault("stack overflow", self.PC, SP + 1)
+    self.registers[self.SP] = SP
+    self.ram_write(self.registers[reg_num], SP)
     self.PC += num_operands
 
 
-def handle_ADD(self, *args):
-    reg_a, reg_b, num_operands = args[0], args[1], args[2]
-    self.alu("ADD", reg_a, reg_b)
-    self.PC += num_operands
-
-
-def handle_PUSH(self, *args):
-    self.registers[self.SP] -= 1
-    valueToPush, num_operands = self.registers[args[0]], args[2]
-    self.ram_write(valueToPush, self.registers[self.SP])
-    self.PC += num_operands
-
-
-def handle_POP(self, *args):
-    if self.registers[self.SP] == 0xF4:
-        print("\n*** THE STACK IS EMPTY. EXITING... TO AVOID UNDERFLOWING ***\n")
-        sys.exit(1)
+def handle_POP(self, reg_to_store_in, operand_b, num_operands):
+    if self.registers[self.SP] >= self.stack_top:
+        raise StackFault("stack underflow", self.PC, self.registers[self.SP])
 
-    reg_to_store_in, num_operands = args[0], args[2]
     value_to_store = self.ram_read(self.registers[self.SP])
     self.registers[reg_to_store_in] = value_to_store
-    self.registers[self.SP] += 1
+    self.registers[self.SP] = (self.registers[self.SP] + 1) & 0xFF
     self.PC += num_operands
 
 
-def handle_JMP(self, *args):
-    reg_to_jump_to = self.registers[args[0]]
-    self.PC = reg_to_jump_to
+def handle_JMP(self, reg_num, operand_b, num_operands):
+    self.PC = self.registers[reg_num]
 
 
-def handle_ST(self, *args):
-    value_to_store, num_operands = self.registers[args[1]], args[2]
-    address_to_store_at = self.registers[args[0]]
-    self.ram_write(value_to_store, address_to_store_at)
+def handle_ST(self, reg_a, reg_b, num_operands):
+    self.ram_write(self.registers[reg_b], self.registers[reg_a])
     self.PC += num_operands
 
 
-def handle_PRA(self, *args):
-    num_operands = args[2]
-    value = self.registers[args[0]]
-    print(chr(value)) if value else None
+def handle_PRA(self, reg_num, operand_b, num_operands):
+    value = self.registers[reg_num]
+    self.output.char(value) if value else None
     self.PC += num_operands
 
 
-def handle_IRET(self, *args):
-    s_registers = self.ram_read(self.registers[self.SP])
-    self.registers[self.SP] += 1
-    s_FL = self.ram_read(self.registers[self.SP])
-    self.registers[self.SP] += 1
-    s_PC = self.ram_read(self.registers[self.SP])
-    self.registers[self.SP] += 1
-
-    self.registers = s_registers + self.registers[6:]
-    self.FL = s_FL
-    self.PC = s_PC
+def handle_IRET(self, operand_a, operand_b, num_operands):
+    SP = self.registers[self.SP]
+    if SP + 9 > self.stack_top:
+        raise StackFault("stack underflow", self.PC, SP)
+    # the frame stack_cpu_state pushed, from SP up: R6 ... R0, FL, PC
+    frame = self.ram[SP:SP + 9]
+    # interrupts raised while the handler ran stay pending
+    pending = self.registers[self.IS]
+    self.registers[6::-1] = frame[:7]
+    self.registers[self.IS] |= pending
+    self.FL = frame[7]
+    self.PC = frame[8]
+    self.registers[self.SP] = SP + 9
     self.interrupts_enabled = True
+    self.next_check = 0  # deliver anything that came in meanwhile
 
 
-def handle_LD(self, *args):
-    reg_a, reg_b, num_operands = args[0], args[1], args[2]
-    value_to_load = self.ram_read(self.registers[reg_b])
-    self.registers[reg_a] = value_to_load
+def handle_INT(self, reg_num, operand_b, num_operands):
+    self.registers[self.IS] |= 1 << (self.registers[reg_num] & 7)
+    self.next_check = 0  # dispatch it before the next instruction
     self.PC += num_operands
 
 
-def handle_CALL(self, *args):
-    reg_n, num_operands,  = args[0], args[2]
-    self.registers[self.SP] -= 1
-    self.ram_write(self.PC + num_operands, self.registers[self.SP])
-    self.PC = self.registers[reg_n]
+def handle_LD(self, reg_a, reg_b, num_operands):
+    self.registers[reg_a] = self.ram_read(self.registers[reg_b])
+    self.PC += num_operands
+
 
+def handle_CALL(self, reg_num, operand_b, num_operands):
+    SP = self.registers[self.SP] - 1
+    if SP <= self.stack_guard:
+        raise StackFault("stack overflow", self.PC, SP + 1)
+    self.registers[self.SP] = SP
+    self.ram_write(self.PC + num_operands, SP)
+    self.PC = self.registers[reg_num]
 
-def handle_RET(self, *args):
+
+def handle_RET(self, operand_a, operand_b, num_operands):
+    if self.registers[self.SP] >= self.stack_top:
+        raise StackFault("stack underflow", self.PC, self.registers[self.SP])
     self.PC = self.ram_read(self.registers[self.SP])
-    self.registers[self.SP] += 1
+    self.registers[self.SP] = (self.registers[self.SP] + 1) & 0xFF
 
-def handle_CMP(self, *args):
-    reg_a, reg_b, num_operands = args[0], args[1], args[2]
-    self.alu("CMP", reg_a, reg_b)
-    self.PC += num_operands
-    
-def handle_JEQ(self, *args):
+
+def handle_JEQ(self, reg_num, operand_b, num_operands):
     if self.FL & 1 == 1:
-        handle_JMP(self, *args)
+        self.PC = self.registers[reg_num]
     else:
-        self.PC += args[2]
+        self.PC += num_operands
+
 
-def handle_JNE(self, *args):
+def handle_JNE(self, reg_num, operand_b, num_operands):
     if self.FL & 1 == 0:
-        handle_JMP(self, *args)
+        self.PC = self.registers[reg_num]
     else:
-        self.PC += args[2]
-        
-def handle_AND(self, *args):
-    reg_a, reg_b, num_operands = args[0], args[1], args[2]
-    self.alu("AND", reg_a, reg_b)
-    self.PC += num_operands
-    
-def handle_OR(self, *args):
-    reg_a, reg_b, num_operands = args[0], args[1], args[2]
-    self.alu("OR", reg_a, reg_b)
-    self.PC += num_operands
-    
-def handle_XOR(self, *args):
-    reg_a, reg_b, num_operands = args[0], args[1], args[2]
-    self.alu("XOR", reg_a, reg_b)
-    self.PC += num_operands
-    
-def handle_NOT(self, *args):
-    reg, num_operands = args[0], args[2]
-    self.alu("NOT", reg)
-    self.PC += num_operands
-    
-def handle_SHL(self, *args):
-    reg_a, reg_b, num_operands = args[0], args[1], args[2]
-    self.alu("SHL", reg_a, reg_b)
-    self.PC += num_operands
-    
-def handle_SHR(self, *args):
-    reg_a, reg_b, num_operands = args[0], args[1], args[2]
-    self.alu("SHR", reg_a, reg_b)
-    self.PC += num_operands
-    
-def handle_MOD(self, *args):
-    reg_a, reg_b, num_operands = args[0], args[1], args[2]
-    self.alu("MOD", reg_a, reg_b)
-    self.PC += num_operands
-    
-def handle_ADDI(self, *args):
-    reg, value, num_operands = args[0], args[1], args[2]
-    self.alu("ADDI", reg, value)
-    self.PC += num_operands
-    
-def handle_INC(self, *args):
-    reg, num_operands = args[0], args[2]
-    self.alu("INC", reg)
+        self.PC += num_operands
+
+
+def handle_JGT(self, reg_num, operand_b, num_operands):
+    if self.FL & 2:
+        self.PC = self.registers[reg_num]
+    else:
+        self.PC += num_operands
+
+
+def handle_JLT(self, reg_num, operand_b, num_operands):
+    if self.FL & 4:
+        self.PC = self.registers[reg_num]
+    else:
+        self.PC += num_operands
+
+
+def handle_JLE(self, reg_num, operand_b, num_operands):
+    if self.FL & 5:
+        self.PC = self.registers[reg_num]
+    else:
+        self.PC += num_operands
+
+
+def handle_JGE(self, reg_num, operand_b, num_operands):
+    if self.FL & 3:
+        self.PC = self.registers[reg_num]
+    else:
+        self.PC += num_operands
+
+
+def handle_NOP(self, operand_a, operand_b, num_operands):
     self.PC += num_operands
 
-def handle_DEC(self, *args):
-    reg, num_operands = args[0], args[2]
-    self.alu("DEC", reg)
-    self.PC += num_operands
\ No newline at end of file
+
+def handle_unknown(self, operand_a, operand_b, num_operands):
+    raise InstructionFault("unknown instruction", self.PC, self.ram[self.PC])
+
+
+# the helper for each instruction in isa.py, the ALU ones are the
+# alu.TABLE functions themselves and a missing one fails the import
+HANDLERS = {}
+for ins in isa.INSTRUCTIONS:
+    if alu.TABLE[ins.opcode] is not alu.alu_unsupported:
+        HANDLERS[ins.opcode] = alu.TABLE[ins.opcode]
+    else:
+        HANDLERS[ins.opcode] = globals()["handle_" + ins.name]
+
+# the dense dispatch array indexed by the raw opcode byte, CPU copies it
+# into its branch_table
+DISPATCH = [handle_unknown] * 256
+for opcode, handler in HANDLERS.items():
+    DISPATCH[opcode] = handler
+
+# opcode -> mnemonic
+NAMES = isa.NAMES
+
+# the instructions that write the register named by their first operand
+WRITES_REGISTER = {ins.opcode for ins in isa.INSTRUCTIONS if "a" in ins.writes.split()}
+
+
+def rechecking(handler):
+    """handler for an instruction writing IM or IS, the interrupts are
+    looked at again before the next instruction"""
+    def handle(self, operand_a, operand_b, num_operands):
+        handler(self, operand_a, operand_b, num_operands)
+        self.next_check = 0
+    return handle
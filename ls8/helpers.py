@@ -1,40 +1,116 @@
+import os
+import sys
+from faults import InstructionFault, StackFault
+from sourcemap import SourceMap
+
+# where asm.py lives
+ASM_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "asm")
+
+
+def program_path(file_name):
+    # a bare file name is looked up in examples/
+    if not os.path.exists(file_name):
+        return f"examples/{file_name}"
+    return file_name
+
+
 def write_program_to_ram(self, file_name):
+    program = bytearray()
     try:
-        with open(f"examples/{file_name}") as fp:
+        with open(program_path(file_name)) as fp:
             for l in fp:
                 binary_string = l.partition("#")[0].strip()
                 if len(binary_string):
-                    self.ram_write(int(binary_string, 2), self.address)
-                    self.address += 1 
+                    program.append(int(binary_string, 2) & 0xFF)
     except FileNotFoundError:
         print("*** THE SPECIFIED FILE NAME DOESN'T EXIST ***")
+    # copy the whole program in at once
+    self.load_bytes(program, self.address)
+
+
+def assembler():
+    # import asm.py from the asm/ directory next to this one
+    if ASM_DIR not in sys.path:
+        sys.path.append(ASM_DIR)
+    import asm
+    return asm
+
+
+def write_source_to_ram(self, source):
+    debug = {}
+    program = assembler().assemble(source, self.symbols, debug)
+    self.load_bytes(program, self.address)
+    self.source_map = SourceMap(debug)
+
 
-def clear_bit(self, position):
-    mask = 1 << position
-    self.registers[self.IS] &= ~mask
-    
 def set_FL_kth_bit(self, reg_a, reg_b):
+    # FL is 00000LGE, a CMP clears the flags it doesn't set
     if self.registers[reg_a] == self.registers[reg_b]:
-        self.FL = ((1 << 0) | self.FL)
+        self.FL = 1 << 0
     elif self.registers[reg_a] > self.registers[reg_b]:
-        self.FL = ((1 << 1) | self.FL)
+        self.FL = 1 << 1
     else:
-        self.FL = ((1 << 2) | self.FL)
+        self.FL = 1 << 2
+
+# an interrupt frame is PC, FL and R0-R6
+FRAME_SIZE = 9
+
+# the vector table entry of the interrupt to take for every IM & IS value,
+# the lowest set bit has the highest priority
+VECTORS = [None] + [0xF8 + (m & -m).bit_length() - 1 for m in range(1, 256)]
+
 
 def stack_cpu_state(self):
-    for i in [self.PC, self.FL, self.registers[:6]]:
-        self.registers[self.SP] -= 1
-        self.ram_write(i, self.registers[self.SP])
+    """Push PC, FL, then R0-R6 as in the spec, as one 9 byte write"""
+    if self.PC >= len(self.ram):
+        # it ran off the end of RAM, there is nothing to return to
+        raise InstructionFault("PC out of range", self.PC)
+    SP = self.registers[self.SP] - FRAME_SIZE
+    if SP <= self.stack_guard:
+        raise StackFault("stack overflow", self.PC, self.registers[self.SP])
+    # from SP up: R6 ... R0, FL, PC
+    frame = self.registers[6::-1]
+    frame.append(self.FL)
+    frame.append(self.PC)
+    self.write_bytes(frame, SP)
+    self.registers[self.SP] = SP
+
+
+def dispatch_interrupt(self):
+    masked_interrupts = self.registers[self.IM] & self.registers[self.IS]
+    if masked_interrupts:
+        # disable further interrupts
+        self.interrupts_enabled = False
+        # clear the bit in the IS register
+        self.registers[self.IS] &= ~(masked_interrupts & -masked_interrupts)
+        # store the state of the cpu
+        stack_cpu_state(self)
+        # set PC to the interrupt handler address
+        self.PC = self.ram[VECTORS[masked_interrupts]]
 
 
 def run_timer_interrupt(self):
+    if self.recorder is not None:
+        self.recorder.record(self.cycles, "timer")
     self.registers[self.IS] |= 1  # set bit 0 in the IS
+    self.next_check = 0  # check the interrupts before the next instruction
 
 
 def run_keyboard_interrupt(self, e):
-    self.registers[self.IS] |= 2
+    """Called on the keyboard's thread, poll() delivers the key"""
     try:
-        self.ram_write(ord(e.name), 0xF4)
+        key = ord(e.name)
     except TypeError:
-        self.ram_write(0, 0xF4)
+        key = 0
         print(e.name)
+    self.key_presses.put(key)
+    self.next_check = 0
+
+
+def run_key_interrupt(self, key):
+    """A key press from the keyboard, a ScriptedInput or a Replay"""
+    if self.recorder is not None:
+        self.recorder.record(self.cycles, "key", key)
+    self.registers[self.IS] |= 2  # set bit 1 in the IS
+    self.next_check = 0
+    self.ram_write(key, 0xF4)
@@ -0,0 +1,81 @@
+"""The .ls8b binary program image.
+
+    offset  size  field
+    0       4     magic, b"LS8B"
+    4       1     format version, 1
+    5       1     load address
+    6       1     entry point, the initial PC
+    7       1     number of symbols
+    8       2     code length, little endian
+    10      ...   symbols, each an address byte, a name length byte and the
+                  ASCII name
+    ...     ...   the code bytes
+
+asm.py writes it with pack_image() when the output file ends in .ls8b.
+"""
+
+import mmap
+import os
+import struct
+
+MAGIC = b"LS8B"
+VERSION = 1
+HEADER = struct.Struct("<4sBBBBH")
+
+
+def pack_image(code, load_address=0, entry=0, symbols=None):
+    """Return the image of code as bytes"""
+    symbols = symbols or {}
+    parts = [HEADER.pack(MAGIC, VERSION, load_address, entry, len(symbols), len(code))]
+    for name, address in symbols.items():
+        name = name.encode("ascii")
+        parts.append(bytes([address, len(name)]) + name)
+    parts.append(bytes(code))
+    return b"".join(parts)
+
+
+def unpack_image(data):
+    """Return (load_address, entry, symbols, code) from any bytes-like
+    image, code is a memoryview into data"""
+    # released on the way out, so a failed unpack doesn't keep data (an
+    # mmap, say) exported through the traceback
+    with memoryview(data) as view:
+        if len(view) < HEADER.size:
+            raise ValueError("not an LS-8 image, too short")
+        magic, version, load_address, entry, num_symbols, length = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError("not an LS-8 image, bad magic")
+        if version != VERSION:
+            raise ValueError(f"unsupported LS-8 image version {version}")
+
+        symbols = {}
+        offset = HEADER.size
+        for _ in range(num_symbols):
+            if offset + 2 > len(view) or offset + 2 + view[offset + 1] > len(view):
+                raise ValueError("LS-8 image symbols cut short")
+            address, name_length = view[offset], view[offset + 1]
+            name = bytes(view[offset + 2:offset + 2 + name_length]).decode("ascii")
+            symbols[name] = address
+            offset += 2 + name_length
+
+        if offset + length > len(view) or load_address + length > 256:
+            raise ValueError("LS-8 image code doesn't fit")
+        return load_address, entry, symbols, view[offset:offset + length]
+
+
+def load_image(self, data):
+    """Copy an image straight into the CPU's RAM and point PC at its entry"""
+    load_address, entry, symbols, code = unpack_image(data)
+    with code:
+        self.load_bytes(code, load_address)
+    self.symbols.update(symbols)
+    self.PC = entry
+
+
+def load_image_file(self, file_name):
+    with open(file_name, "rb") as fp:
+        # mmap can't map an empty file
+        if os.fstat(fp.fileno()).st_size == 0:
+            raise ValueError("not an LS-8 image, empty file")
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            load_image(self, data)
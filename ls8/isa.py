@@ -0,0 +1,108 @@
+"""The LS-8 instruction set, described once.
+
+Every instruction is an Instruction: its mnemonic, opcode byte, operand
+layout, the registers it writes, the FL bits it sets and its cost in
+cycles. The assembler builds its OPCODES table from INSTRUCTIONS and
+handlers.py its opcode constants and dispatch array, so an instruction
+added here is assembled and run, or fails at import time if it has no
+handle_<name>.
+
+Operand layouts:
+
+    ""    no operands
+    "r"   a register
+    "rr"  two registers
+    "ri"  a register and an immediate byte
+
+The conditional jumps are described by CONDITIONS, which the handlers, the
+block compiler, the superinstructions and the profiler all go by.
+"""
+
+from collections import namedtuple
+
+Instruction = namedtuple("Instruction", "name opcode operands writes flags cycles")
+
+# writes names the registers an instruction changes: "a" its first operand,
+# "SP" the stack pointer and "*" any of them, as it runs other code. FL is
+# 00000LGE, flags names the bits an instruction sets. Every instruction
+# costs one cycle, the timer and cycle limits count those
+INSTRUCTIONS = [
+    Instruction("ADD", 0b10100000, "rr", "a", "", 1),
+    Instruction("ADDI", 0b10100101, "ri", "a", "", 1),
+    Instruction("AND", 0b10101000, "rr", "a", "", 1),
+    Instruction("CALL", 0b01010000, "r", "*", "", 1),
+    Instruction("CMP", 0b10100111, "rr", "", "LGE", 1),
+    Instruction("DEC", 0b01100110, "r", "a", "", 1),
+    Instruction("DIV", 0b10100011, "rr", "a", "", 1),
+    Instruction("HLT", 0b00000001, "", "", "", 1),
+    Instruction("INC", 0b01100101, "r", "a", "", 1),
+    Instruction("INT", 0b01010010, "r", "*", "", 1),
+    Instruction("IRET", 0b00010011, "", "*", "LGE", 1),
+    Instruction("JEQ", 0b01010101, "r", "", "", 1),
+    Instruction("JGE", 0b01011010, "r", "", "", 1),
+    Instruction("JGT", 0b01010111, "r", "", "", 1),
+    Instruction("JLE", 0b01011001, "r", "", "", 1),
+    Instruction("JLT", 0b01011000, "r", "", "", 1),
+    Instruction("JMP", 0b01010100, "r", "", "", 1),
+    Instruction("JNE", 0b01010110, "r", "", "", 1),
+    Instruction("LD", 0b10000011, "rr", "a", "", 1),
+    Instruction("LDI", 0b10000010, "ri", "a", "", 1),
+    Instruction("MOD", 0b10100100, "rr", "a", "", 1),
+    Instruction("MUL", 0b10100010, "rr", "a", "", 1),
+    Instruction("NOP", 0b00000000, "", "", "", 1),
+    Instruction("NOT", 0b01101001, "r", "a", "", 1),
+    Instruction("OR", 0b10101010, "rr", "a", "", 1),
+    Instruction("POP", 0b01000110, "r", "a SP", "", 1),
+    Instruction("PRA", 0b01001000, "r", "", "", 1),
+    Instruction("PRN", 0b01000111, "r", "", "", 1),
+    Instruction("PUSH", 0b01000101, "r", "SP", "", 1),
+    Instruction("RET", 0b00010001, "", "SP", "", 1),
+    Instruction("SHL", 0b10101100, "rr", "a", "", 1),
+    Instruction("SHR", 0b10101101, "rr", "a", "", 1),
+    Instruction("ST", 0b10000100, "rr", "", "", 1),
+    Instruction("SUB", 0b10100001, "rr", "a", "", 1),
+    Instruction("XOR", 0b10101011, "rr", "a", "", 1),
+]
+
+# mnemonic -> opcode byte, and back
+OPCODES = {ins.name: ins.opcode for ins in INSTRUCTIONS}
+NAMES = {ins.opcode: ins.name for ins in INSTRUCTIONS}
+BY_OPCODE = {ins.opcode: ins for ins in INSTRUCTIONS}
+BY_NAME = {ins.name: ins for ins in INSTRUCTIONS}
+
+# conditional jump -> (FL bits, whether it jumps when any of them is set)
+CONDITIONS = {
+    OPCODES["JEQ"]: (0b001, True),
+    OPCODES["JNE"]: (0b001, False),
+    OPCODES["JGT"]: (0b010, True),
+    OPCODES["JLT"]: (0b100, True),
+    OPCODES["JLE"]: (0b101, True),
+    OPCODES["JGE"]: (0b011, True),
+}
+
+
+def taken(opcode, FL):
+    """Whether the conditional jump opcode jumps with the flags FL"""
+    bits, when_set = CONDITIONS[opcode]
+    return bool(FL & bits) == when_set
+
+
+def jump_table(opcode):
+    """taken() for every FL value, indexed by FL"""
+    return [taken(opcode, FL) for FL in range(256)]
+
+
+def disassemble(ram, address):
+    """The instruction at address as assembler text, e.g. "LDI R0,12",
+    a byte that isn't an opcode comes out as DB"""
+    ins = BY_OPCODE.get(ram[address])
+    if ins is None:
+        return f"DB 0x{ram[address]:02x}"
+    operands = [ram[i] if i < len(ram) else 0 for i in (address + 1, address + 2)]
+    if ins.operands == "r":
+        return f"{ins.name} R{operands[0]}"
+    if ins.operands == "rr":
+        return f"{ins.name} R{operands[0]},R{operands[1]}"
+    if ins.operands == "ri":
+        return f"{ins.name} R{operands[0]},{operands[1]}"
+    return ins.name
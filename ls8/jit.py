@@ -0,0 +1,296 @@
+"""Basic-block compiler for the LS-8.
+
+Straight-line runs of instructions are turned into Python source once,
+compiled with compile() and cached by their start address. A block ends at
+the first instruction that sets the PC itself (JMP, JEQ, JNE, CALL, RET,
+IRET, ...) or at HLT. precompile() compiles them ahead of time from the
+block starts of a static analysis (see cfg.py).
+
+A block keeps the registers it uses in locals, and one that jumps back to
+its own start loops in place while another round ends before the run loop
+is due to poll. owners maps every RAM byte to the blocks compiled from it,
+so writes to the stack and data cost a single look up and only writes to
+code drop blocks.
+"""
+
+import re
+import handlers as hd
+import isa
+from faults import InstructionFault
+
+# the longest block we compile, so interrupts are still checked regularly
+MAX_BLOCK_LENGTH = 64
+
+# python statements for the instructions that can be inlined, {a} and {b}
+# are the operand bytes and {next} the address of the following instruction
+TEMPLATES = {
+    hd.LDI: ["regs[{a}] = {b}"],
+    hd.LD: ["regs[{a}] = ram[regs[{b}]]"],
+    hd.ADD: ["regs[{a}] = (regs[{a}] + regs[{b}]) & 0xFF"],
+    hd.SUB: ["regs[{a}] = (regs[{a}] - regs[{b}]) & 0xFF"],
+    hd.MUL: ["regs[{a}] = (regs[{a}] * regs[{b}]) & 0xFF"],
+    hd.AND: ["regs[{a}] &= regs[{b}]"],
+    hd.OR: ["regs[{a}] |= regs[{b}]"],
+    hd.XOR: ["regs[{a}] ^= regs[{b}]"],
+    hd.NOT: ["regs[{a}] = ~regs[{a}] & 0xFF"],
+    hd.SHL: ["regs[{a}] = (regs[{a}] << regs[{b}]) & 0xFF"],
+    hd.SHR: ["regs[{a}] >>= regs[{b}]"],
+    hd.ADDI: ["regs[{a}] = (regs[{a}] + {b}) & 0xFF"],
+    hd.INC: ["regs[{a}] = (regs[{a}] + 1) & 0xFF"],
+    hd.DEC: ["regs[{a}] = (regs[{a}] - 1) & 0xFF"],
+    hd.NOP: [],
+    hd.CMP: [
+        "x, y = regs[{a}], regs[{b}]",
+        "cpu.FL = 1 if x == y else 2 if x > y else 4",
+    ],
+    hd.PRN: ["cpu.output.number({a}, regs[{a}])"],
+    hd.PRA: [
+        "if regs[{a}]:",
+        "    cpu.output.char(regs[{a}])",
+    ],
+    hd.ST: [
+        "ram[regs[{a}]] = regs[{b}]",
+        # the write hit compiled code, maybe this very block, leave it
+        # before going on
+        "if owners[regs[{a}]]:",
+        "    jit.invalidate(regs[{a}])",
+        "    cpu.PC = {next}",
+        "    return {count}",
+    ],
+    hd.PUSH: [
+        # the handler raises the stack fault
+        "if regs[7] - 1 <= cpu.stack_guard:",
+        "    cpu.PC = {addr}",
+        "    jit.ran = {count} - 1",
+        "    handlers[{op}](cpu, {a}, {b}, {n})",
+        "regs[7] -= 1",
+        "ram[regs[7]] = regs[{a}]",
+        "if owners[regs[7]]:",
+        "    jit.invalidate(regs[7])",
+        "    cpu.PC = {next}",
+        "    return {count}",
+    ],
+    hd.POP: [
+        "if regs[7] >= cpu.stack_top:",
+        "    cpu.PC = {addr}",
+        "    jit.ran = {count} - 1",
+        "    handlers[{op}](cpu, {a}, {b}, {n})",
+        "regs[{a}] = ram[regs[7]]",
+        # POP R7 leaves SP one past the value popped, as handle_POP does
+        "regs[7] = (regs[7] + 1) & 0xFF",
+    ],
+}
+
+# python statements for the instructions that end a block
+EXITS = {
+    hd.JMP: ["cpu.PC = regs[{a}]"],
+    hd.CALL: [
+        "if regs[7] - 1 <= cpu.stack_guard:",
+        "    cpu.PC = {addr}",
+        "    jit.ran = {count} - 1",
+        "    handlers[{op}](cpu, {a}, {b}, {n})",
+        "regs[7] -= 1",
+        "ram[regs[7]] = {ret}",
+        "if owners[regs[7]]:",
+        "    jit.invalidate(regs[7])",
+        "cpu.PC = regs[{a}]",
+    ],
+    hd.RET: [
+        "if regs[7] >= cpu.stack_top:",
+        "    cpu.PC = {addr}",
+        "    jit.ran = {count} - 1",
+        "    handlers[{op}](cpu, {a}, {b}, {n})",
+        "cpu.PC = ram[regs[7]]",
+        "regs[7] += 1",
+    ],
+}
+
+# and the conditional jumps, JEQ, JNE, JGT, ...
+for opcode, (bits, when_set) in isa.CONDITIONS.items():
+    test = f"cpu.FL & {bits}" if when_set else f"not cpu.FL & {bits}"
+    EXITS[opcode] = [f"cpu.PC = regs[{{a}}] if {test} else {{next}}"]
+
+# anything else is run through its branch_table handler
+FALLBACK = [
+    "cpu.PC = {addr}",
+    "jit.ran = {count} - 1",  # in case it faults
+    "handlers[{op}](cpu, {a}, {b}, {n})",
+    "regs = cpu.registers",
+]
+
+
+REGISTER = re.compile(r"regs\[([0-7])\]")
+ASSIGNED = re.compile(r"^\s*regs\[([0-7])\] *[-+&|^>]*=", re.MULTILINE)
+
+
+def cache_registers(lines):
+    """Rewrite the body lines of a block to keep the registers it names
+    in locals r0-r7: loaded on entry, the ones it assigns stored back
+    before every return and handler call, and all loaded again after the
+    call"""
+    source = "\n".join(lines)
+    used = sorted(set(REGISTER.findall(source)))
+    if not used:
+        return lines
+    assigned = sorted(set(ASSIGNED.findall(source)))
+
+    def assignment(regs, values):
+        return ", ".join(regs) + " = " + ", ".join(values)
+
+    load = assignment(["r" + reg for reg in used], [f"regs[{reg}]" for reg in used])
+    store = assignment([f"regs[{reg}]" for reg in assigned], ["r" + reg for reg in assigned])
+
+    cached = ["    " + load]
+    for line in lines:
+        indent = line[:len(line) - len(line.lstrip())]
+        if line.lstrip() == "regs = cpu.registers":
+            continue  # the handler call before it reloads them
+        line = REGISTER.sub(r"r\1", line)
+        calls = "handlers[" in line
+        if assigned and (calls or line.lstrip().startswith("return")):
+            cached.append(indent + store)
+        cached.append(line)
+        if calls:
+            cached.append(indent + load)
+    return cached
+
+
+def ends_block(IR):
+    """HLT and every instruction that sets the PC itself end a block"""
+    return IR == hd.HALT or (IR >> 4) & 1 == 1
+
+
+class BlockCompiler:
+    """Compiles and caches the basic blocks of the program in a CPU's RAM."""
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.blocks = [None] * len(cpu.decoded)  # past the end of RAM too
+        self.spans = {}  # start address -> end address of every cached block
+        # the start addresses of the cached blocks each RAM byte belongs
+        # to, so a write outside compiled code costs one look up
+        self.owners = [()] * len(cpu.ram)
+        self.ran = 0  # instructions a block ran before it faulted
+        self.namespace = {
+            "ram": cpu.ram,
+            "owners": self.owners,
+            "handlers": cpu.branch_table,
+            "jit": self,
+        }
+
+    def drop(self, start):
+        """Forget the cached block starting at start"""
+        end = min(self.spans.pop(start), len(self.owners))
+        self.blocks[start] = None
+        owners = self.owners
+        for address in range(start, end):
+            owners[address] = tuple(s for s in owners[address] if s != start)
+
+    def invalidate(self, address):
+        """Drop every cached block that contains the written address"""
+        for start in self.owners[address]:
+            self.drop(start)
+
+    def invalidate_range(self, first, last):
+        """Drop every cached block overlapping first up to last"""
+        starts = set()
+        for owners in self.owners[first:last]:
+            starts.update(owners)
+        for start in starts:
+            self.drop(start)
+
+    def generate(self, address):
+        """Return the python source of the block starting at address"""
+        cpu = self.cpu
+        instructions = []
+        end = address
+        while True:
+            IR = cpu.ram[end]
+            num_operands = (IR >> 6) + 1
+            a = cpu.ram_read(end + 1)
+            instructions.append((IR, dict(
+                addr=end,
+                op=IR,
+                a=a,
+                b=cpu.ram_read(end + 2),
+                n=num_operands,
+                next=end + num_operands,
+                ret=(end + num_operands) & 0xFF,  # what CALL pushes
+            )))
+            end += num_operands
+            ends = ends_block(IR) or end >= len(cpu.ram)
+            # unmasking or raising an interrupt dispatches it right away
+            rechecks = IR in hd.WRITES_REGISTER and a in (cpu.IM, cpu.IS)
+            if ends or rechecks or len(instructions) == MAX_BLOCK_LENGTH:
+                break
+
+        # a block that jumps back to its own start runs again right away
+        # while another round ends before the run loop's next poll,
+        # counting in done
+        loops = ends and (IR == hd.JMP or IR in isa.CONDITIONS)
+        indent = " " * (8 if loops else 4)
+
+        lines = []
+        if loops:
+            lines += ["    done = 0", "    while True:"]
+
+        for count, (IR, fields) in enumerate(instructions, 1):
+            fields["count"] = f"done + {count}" if loops else count
+
+            if count == len(instructions) and ends:
+                if IR in EXITS:
+                    body = EXITS[IR]
+                else:
+                    # the handler moves the PC (or halts) by itself
+                    body = FALLBACK[:3]
+            elif IR in TEMPLATES:
+                body = TEMPLATES[IR]
+            else:
+                # MOD and DIV halt the CPU on a division by 0
+                body = FALLBACK + [
+                    "if cpu.halted:",
+                    "    cpu.PC = {next}",
+                    "    return {count}",
+                ]
+            lines += [indent + l.format(**fields) for l in body]
+
+        if loops:
+            lines += [
+                f"        done += {count}",
+                f"        if cpu.PC != {address} or cycles + done + {count} > cpu.next_check:",
+                "            return done",
+            ]
+        else:
+            if not ends:
+                lines.append(f"    cpu.PC = {end}")
+            if rechecks:
+                lines.append("    cpu.next_check = 0")
+            lines.append(f"    return {count}")
+
+        lines = cache_registers(lines)
+        header = [f"def block_{address}(cpu, cycles):", "    regs = cpu.registers"]
+        return "\n".join(header + lines), end
+
+    def compile(self, address):
+        """Compile the block starting at address and cache it"""
+        if address >= len(self.cpu.ram):
+            self.ran = 0  # no block ran
+            raise InstructionFault("PC out of range", address)
+        source, end = self.generate(address)
+        code = compile(source, f"<ls8 block {address}>", "exec")
+        exec(code, self.namespace)
+        block = self.namespace.pop(f"block_{address}")
+        self.blocks[address] = block
+        self.spans[address] = end
+        owners = self.owners
+        for i in range(address, min(end, len(owners))):
+            owners[i] += (address,)
+        return block
+
+    def precompile(self, starts):
+        """Compile the blocks at starts up front instead of when the PC
+        first gets there, e.g. the block starts cfg.Analysis found"""
+        for address in starts:
+            if self.blocks[address] is None:
+                self.compile(address)
+
@@ -0,0 +1,273 @@
+"""Many LS-8 machines stepped together with NumPy.
+
+LockstepCPU holds the RAM (N x 256) and the registers (N x 8) of N machines
+and executes one instruction on every running machine per step, each with
+its own output device (CaptureOutput unless replaced). Machines
+sitting at the same PC with the same instruction are run as one group, so a
+program that doesn't branch on its input costs one handler call per step no
+matter how many machines there are.
+
+The groups are run through the handlers in handlers.py on a Lanes view
+whose registers, PC and FL are NumPy vectors. Only the instructions whose
+handler branches on a value (CMP, the conditional jumps, DIV, MOD, the
+stack instructions) or prints (PRN, PRA) have vectorized versions here. A
+fault halts just the machines that hit it, with the reason the CPU would
+raise. Interrupts are not delivered.
+"""
+
+import numpy as np
+import alu
+import helpers as hp
+import image
+import handlers as hd
+import isa
+from devices import CaptureOutput
+
+
+class Lanes:
+    """The machines of a LockstepCPU running the same instruction, shaped
+    so the handlers in handlers.py work on all of them at once."""
+
+    def __init__(self, machine, lanes):
+        self.machine = machine
+        self.lanes = lanes
+        # one row per register, one column per machine
+        self.registers = machine.registers[lanes].T.astype(np.int64)
+        self.PC = machine.PC[lanes]
+        self.FL = machine.FL[lanes]
+        self.halted = False
+        self.SP = 7
+        self.IM = 5
+        self.IS = 6
+
+    def ram_read(self, MAR):
+        return self.machine.ram[self.lanes, MAR].astype(np.int64)
+
+    def ram_write(self, MDR, address):
+        self.machine.ram[self.lanes, address] = np.bitwise_and(MDR, 0xFF)
+
+    def alu(self, op, reg_a, reg_b=None):
+        VECTOR_HANDLERS[op](self, reg_a, reg_b, 0)
+
+    def halt(self, mask, reason, message=None):
+        """Halt the machines selected by mask with a reason, printing
+        message on their output if given"""
+        self.halted = self.halted | mask
+        for lane in self.lanes[mask]:
+            self.machine.halt_reason[lane] = reason
+            if message is not None:
+                self.machine.output[lane].message(message)
+
+    def commit(self):
+        """Store the group's state back into the machine"""
+        machine, lanes = self.machine, self.lanes
+        machine.registers[lanes] = (self.registers.T & 0xFF).astype(np.uint8)
+        machine.PC[lanes] = self.PC
+        machine.FL[lanes] = self.FL
+        machine.halted[lanes] |= self.halted
+
+
+def handle_PRN(self, reg_num, operand_b, num_operands):
+    for lane, value in zip(self.lanes, self.registers[reg_num]):
+        self.machine.output[lane].number(reg_num, int(value))
+    self.PC = self.PC + num_operands
+
+
+def handle_PRA(self, reg_num, operand_b, num_operands):
+    for lane, value in zip(self.lanes, self.registers[reg_num]):
+        if value:
+            self.machine.output[lane].char(int(value))
+    self.PC = self.PC + num_operands
+
+
+def handle_HALT(self, operand_a, operand_b, num_operands):
+    self.halt(np.ones(len(self.lanes), dtype=bool), "HALT")
+    self.PC = self.PC + num_operands
+    for lane in self.lanes:
+        self.machine.output[lane].halt()
+
+
+def handle_PUSH(self, reg_num, operand_b, num_operands):
+    SP = self.registers[self.SP] - 1
+    full = SP <= self.machine.stack_guard
+    self.halt(full, "stack overflow")
+    ok = ~full
+    self.registers[self.SP] = np.where(full, SP + 1, SP)
+    self.machine.ram[self.lanes[ok], SP[ok]] = self.registers[reg_num][ok] & 0xFF
+    self.PC = np.where(full, self.PC, self.PC + num_operands)
+
+
+def handle_POP(self, reg_num, operand_b, num_operands):
+    SP = self.registers[self.SP]
+    empty = SP >= self.machine.stack_top
+    self.halt(empty, "stack underflow")
+    value = self.ram_read(np.where(empty, 0, SP))
+    self.registers[reg_num] = np.where(empty, self.registers[reg_num], value)
+    self.registers[self.SP] = np.where(empty, SP, (self.registers[self.SP] + 1) & 0xFF)
+    self.PC = np.where(empty, self.PC, self.PC + num_operands)
+
+
+def handle_CALL(self, reg_num, operand_b, num_operands):
+    SP = self.registers[self.SP] - 1
+    full = SP <= self.machine.stack_guard
+    self.halt(full, "stack overflow")
+    ok = ~full
+    self.registers[self.SP] = np.where(full, SP + 1, SP)
+    self.machine.ram[self.lanes[ok], SP[ok]] = (self.PC[ok] + num_operands) & 0xFF
+    self.PC = np.where(full, self.PC, self.registers[reg_num])
+
+
+def handle_RET(self, operand_a, operand_b, num_operands):
+    SP = self.registers[self.SP]
+    empty = SP >= self.machine.stack_top
+    self.halt(empty, "stack underflow")
+    self.PC = np.where(empty, self.PC, self.ram_read(np.where(empty, 0, SP)))
+    self.registers[self.SP] = np.where(empty, SP, SP + 1)
+
+
+def handle_CMP(self, reg_a, reg_b, num_operands):
+    value_a, value_b = self.registers[reg_a], self.registers[reg_b]
+    # FL is 00000LGE
+    self.FL = np.where(value_a == value_b, 1, np.where(value_a > value_b, 2, 4))
+    self.PC = self.PC + num_operands
+
+
+def conditional_jump(bits, when_set):
+    """The handler of a conditional jump in isa.CONDITIONS"""
+    def handle_jump(self, reg_num, operand_b, num_operands):
+        taken = (self.FL & bits != 0) == when_set
+        self.PC = np.where(taken, self.registers[reg_num], self.PC + num_operands)
+    return handle_jump
+
+
+def handle_DIV(self, reg_a, reg_b, num_operands):
+    divisor = self.registers[reg_b]
+    zero = divisor == 0
+    self.halt(zero, "division by 0", alu.DIVISION_BY_ZERO)
+    self.registers[reg_a] = np.where(
+        zero, self.registers[reg_a], self.registers[reg_a] // np.where(zero, 1, divisor)
+    )
+    self.PC = self.PC + num_operands
+
+
+def handle_MOD(self, reg_a, reg_b, num_operands):
+    divisor = self.registers[reg_b]
+    zero = divisor == 0
+    self.halt(zero, "division by 0", alu.DIVISION_BY_ZERO)
+    self.registers[reg_a] = np.where(
+        zero, self.registers[reg_a], self.registers[reg_a] % np.where(zero, 1, divisor)
+    )
+    self.PC = self.PC + num_operands
+
+
+def handle_unknown(self, operand_a, operand_b, num_operands):
+    self.halt(np.ones(len(self.lanes), dtype=bool), "unknown instruction")
+
+
+# the scalar handlers work as they are on vectors, except for these
+VECTOR_HANDLERS = [handle_unknown] * 256
+for opcode, handler in hd.HANDLERS.items():
+    VECTOR_HANDLERS[opcode] = handler
+VECTOR_HANDLERS[hd.PRN] = handle_PRN
+VECTOR_HANDLERS[hd.PRA] = handle_PRA
+VECTOR_HANDLERS[hd.HALT] = handle_HALT
+VECTOR_HANDLERS[hd.PUSH] = handle_PUSH
+VECTOR_HANDLERS[hd.POP] = handle_POP
+VECTOR_HANDLERS[hd.CALL] = handle_CALL
+VECTOR_HANDLERS[hd.RET] = handle_RET
+VECTOR_HANDLERS[hd.CMP] = handle_CMP
+VECTOR_HANDLERS[hd.DIV] = handle_DIV
+VECTOR_HANDLERS[hd.MOD] = handle_MOD
+for opcode, condition in isa.CONDITIONS.items():
+    VECTOR_HANDLERS[opcode] = conditional_jump(*condition)
+# there are no interrupts to raise or return from
+VECTOR_HANDLERS[hd.IRET] = handle_unknown
+VECTOR_HANDLERS[hd.INT] = handle_unknown
+
+
+class LockstepCPU:
+    """N LS-8 machines executing in lockstep."""
+
+    def __init__(self, n):
+        """Construct n machines in their power on state."""
+        self.ram = np.zeros((n, 256), dtype=np.uint8)
+        self.registers = np.zeros((n, 8), dtype=np.uint8)
+        # the same stack limits as CPU
+        self.stack_guard = 0
+        self.stack_top = 0xF4
+        self.registers[:, 7] = self.stack_top
+        self.PC = np.zeros(n, dtype=np.int64)
+        self.FL = np.zeros(n, dtype=np.int64)
+        self.halted = np.zeros(n, dtype=bool)
+        self.cycles = np.zeros(n, dtype=np.int64)
+        self.halt_reason = [None] * n
+        self.output = [CaptureOutput() for _ in range(n)]
+        self.address = 0
+
+    def load(self, file_name):
+        """Load the same program into every machine."""
+        if file_name.endswith(".ls8b"):
+            with open(hp.program_path(file_name), "rb") as fp:
+                load_address, entry, symbols, code = image.unpack_image(fp.read())
+            self.load_bytes(code, load_address)
+            self.PC[:] = entry
+        else:
+            hp.write_program_to_ram(self, file_name)
+
+    def ram_write(self, MDR, address):
+        """Write the value at address in every machine"""
+        self.ram[:, address] = MDR & 0xFF
+
+    def load_bytes(self, data, address=0):
+        """Copy a run of program bytes into every machine at address"""
+        end = address + len(data)
+        if end > self.ram.shape[1]:
+            raise ValueError(f"{len(data)} bytes at address {address} don't fit in RAM")
+        self.ram[:, address:end] = np.frombuffer(bytes(data), dtype=np.uint8)
+        self.address = max(self.address, end)
+        self.stack_guard = max(self.stack_guard, end)
+
+    def step(self):
+        """Run one instruction on every machine that hasn't halted,
+        returns how many machines ran"""
+        running = np.flatnonzero(~self.halted)
+        if not len(running):
+            return 0
+
+        # CPU faults at a PC past the end of RAM rather than wrap it
+        past = self.PC[running] >= self.ram.shape[1]
+        for lane in running[past]:
+            self.halted[lane] = True
+            self.halt_reason[lane] = "PC out of range"
+        running = running[~past]
+        if not len(running):
+            return 0
+
+        PC = self.PC[running]
+        ram = self.ram[running]
+        rows = np.arange(len(running))
+        IR = ram[rows, PC].astype(np.int64)
+        operand_a = ram[rows, (PC + 1) & 0xFF].astype(np.int64)
+        operand_b = ram[rows, (PC + 2) & 0xFF].astype(np.int64)
+
+        # machines that diverged (different PC, code or operands) run apart
+        keys = (PC << 24) | (IR << 16) | (operand_a << 8) | operand_b
+        groups, group_of = np.unique(keys, return_inverse=True)
+        for g, key in enumerate(groups):
+            key = int(key)
+            opcode = (key >> 16) & 0xFF
+            group = Lanes(self, running[group_of == g])
+            VECTOR_HANDLERS[opcode](
+                group, (key >> 8) & 0xFF, key & 0xFF, (opcode >> 6) + 1
+            )
+            group.commit()
+
+        self.cycles[running] += 1
+        return len(running)
+
+    def run(self, max_cycles=None):
+        """Step until every machine halted or max_cycles steps ran"""
+        steps = 0
+        while (max_cycles is None or steps < max_cycles) and self.step():
+            steps += 1
+        return steps
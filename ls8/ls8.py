@@ -2,7 +2,13 @@
 """Main."""
 
 import sys
+import argparse
 from cpu import CPU
+from debugger import Debugger
+from devices import RawOutput, ScriptedInput
+from faults import Fault
+from profiler import Profiler
+from replay import Recorder, Replay
 
 
 # def generate_program(file_name):
@@ -18,18 +24,131 @@ from cpu import CPU
 #         print(f"*** THE SPECIFIED FILE NAME DOESN'T EXIST ***")
 
 
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog=argv[0], description="LS-8 emulator")
+    parser.add_argument("file_name", nargs="?", help="the .ls8 program to run")
+    parser.add_argument("--jit", action="store_true",
+                        help="run compiled basic blocks")
+    parser.add_argument("--precompile", action="store_true",
+                        help="compile the blocks a static analysis of the "
+                             "program finds before it runs (see cfg.py); "
+                             "implies --jit")
+    parser.add_argument("--batch", metavar="DIR_OR_MANIFEST",
+                        help="run every program of a directory or manifest "
+                             "on a process pool, printing JSON lines")
+    parser.add_argument("--workers", type=int,
+                        help="worker processes for --batch")
+    parser.add_argument("--raw", action="store_true",
+                        help="print bare values through a buffer instead "
+                             "of the boxed console output")
+    parser.add_argument("--profile", action="store_true",
+                        help="print per-opcode and per-address counts to "
+                             "stderr after the run")
+    parser.add_argument("--profile-json", metavar="FILE",
+                        help="write the profile to FILE as JSON")
+    parser.add_argument("--max-cycles", type=int,
+                        help="stop a program after this many instructions")
+    parser.add_argument("--headless", action="store_true",
+                        help="don't hook the keyboard (which needs root)")
+    parser.add_argument("--input", metavar="FILE",
+                        help="read key presses from FILE, - for stdin; "
+                             "implies --headless")
+    parser.add_argument("--record", metavar="FILE",
+                        help="log the timer ticks and key presses to FILE")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="deliver the events logged in FILE instead of "
+                             "the timer and the keyboard; implies --headless")
+    parser.add_argument("--debug", action="store_true",
+                        help="run under the debugger, reading its commands "
+                             "from stdin; implies --headless")
+    return parser.parse_args(argv[1:])
+
+
 def main(argv):
     """MAIN"""
-    if len(argv) != 2:
+    args = parse_args(argv)
+    args.jit = args.jit or args.precompile
+
+    if args.batch:
+        import fleet
+        failed = fleet.run_batch(args.batch, sys.stdout, args.workers,
+                                 args.max_cycles, args.jit, args.precompile)
+        return 1 if failed else 0
+
+    if args.file_name is None:
         print(
             f"*** PLEASE SPECIFY THE FILE NAME TO LOAD AS THE SECOND ARGUMENT ***"
         )
         return 1
 
     cpu = CPU()
+    if args.jit:
+        cpu.use_jit()
+    if args.raw:
+        cpu.output = RawOutput()
+
+    try:
+        cpu.load(args.file_name)
+    except (OSError, ValueError) as error:
+        # a bad .ls8b image or a program too big for RAM
+        print(f"*** CAN'T LOAD {args.file_name}: {error} ***")
+        return 1
+    if args.precompile:
+        import cfg
+        cpu.jit.precompile(cfg.Analysis(cpu).block_starts())
+
+    if args.input == "-":
+        cpu.input = ScriptedInput(sys.stdin)
+    elif args.input:
+        cpu.input = ScriptedInput(open(args.input))
+    if args.record:
+        cpu.recorder = Recorder()
+    if args.replay:
+        cpu.replay = Replay.load(args.replay)
+
+    if args.debug:
+        debugger = Debugger(cpu)
+        try:
+            debugger.repl()
+        finally:
+            if cpu.recorder is not None:
+                cpu.recorder.save(args.record)
+        return 0
+
+    profiler = None
+    if args.profile or args.profile_json:
+        profiler = Profiler(cpu)
+
+    headless = args.headless or args.input or args.replay
+    status = 0
+    try:
+        cpu.run(args.max_cycles, interactive=not headless)
+    except Fault as fault:
+        if fault.reason == "stack overflow":
+            message = "THE STACK IS FULL. EXITING... TO AVOID OVERFLOWING"
+        elif fault.reason == "stack underflow":
+            message = "THE STACK IS EMPTY. EXITING... TO AVOID UNDERFLOWING"
+        else:
+            message = str(fault).upper()
+        where = cpu.source_map and cpu.source_map.describe(fault.PC)
+        if where:
+            message += f" AT {where}"
+        cpu.output.message(f"\n*** {message} ***\n")
+        cpu.output.flush()
+        status = 1
+    finally:
+        if cpu.recorder is not None:
+            cpu.recorder.save(args.record)
+
+    if profiler is not None:
+        profiler.detach()
+        if args.profile:
+            print(profiler.report(), file=sys.stderr)
+        if args.profile_json:
+            with open(args.profile_json, "w") as fp:
+                fp.write(profiler.to_json())
 
-    cpu.load(argv[1])
-    cpu.run()
+    return status
 
 
 if __name__ == "__main__":
@@ -0,0 +1,142 @@
+"""Per-opcode and per-PC profiling of CPU.run.
+
+Attaching a Profiler swaps every branch_table entry for a counting wrapper
+and drops the decoded instructions, so the run loop itself is untouched:
+with no profiler attached nothing is counted and nothing is checked.
+
+    profiler = Profiler(cpu)
+    cpu.run()
+    profiler.detach()
+    print(profiler.report())
+
+With a source map loaded (see sourcemap.py) the report names every address
+by its label and source line.
+"""
+
+import json
+import time
+import handlers as hd
+import isa
+from jit import BlockCompiler
+
+
+class Profiler:
+    """Counts executions per opcode and per PC, and conditional jump
+    outcomes."""
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.opcodes = [0] * 256  # executions per opcode
+        self.pcs = [0] * 256  # executions per address
+        self.branches = {}  # address -> [taken, not taken]
+        self.start_cycles = cpu.cycles
+        self.start_time = time.perf_counter()
+        self.end_cycles = None
+        self.end_time = None
+
+        # compiled blocks never go through the branch_table
+        self.used_jit = cpu.jit is not None
+        cpu.jit = None
+
+        # nor do superinstructions
+        self.fused = cpu.fuse
+        cpu.fuse = False
+
+        self.branch_table = cpu.branch_table
+        cpu.branch_table = [
+            self.wrap(opcode, handler) for opcode, handler in enumerate(self.branch_table)
+        ]
+        cpu.decoded[:] = [None] * len(cpu.decoded)
+
+    def wrap(self, opcode, handler):
+        """Return handler counting its executions"""
+        opcodes, pcs, branches = self.opcodes, self.pcs, self.branches
+
+        if opcode in isa.CONDITIONS:
+            # whether it jumps, for every value of FL
+            jumps = isa.jump_table(opcode)
+
+            def profiled(cpu, operand_a, operand_b, num_operands):
+                PC = cpu.PC
+                opcodes[opcode] += 1
+                pcs[PC] += 1
+                counts = branches.setdefault(PC, [0, 0])
+                counts[0 if jumps[cpu.FL] else 1] += 1
+                handler(cpu, operand_a, operand_b, num_operands)
+        else:
+            def profiled(cpu, operand_a, operand_b, num_operands):
+                opcodes[opcode] += 1
+                pcs[cpu.PC] += 1
+                handler(cpu, operand_a, operand_b, num_operands)
+
+        return profiled
+
+    def detach(self):
+        """Put the original branch_table back and stop the clock"""
+        cpu = self.cpu
+        cpu.branch_table = self.branch_table
+        cpu.fuse = self.fused
+        cpu.decoded[:] = [None] * len(cpu.decoded)
+        if self.used_jit:
+            cpu.jit = BlockCompiler(cpu)
+        self.end_cycles = cpu.cycles
+        self.end_time = time.perf_counter()
+
+    def results(self):
+        """Return everything counted as a dict"""
+        cycles = (self.end_cycles if self.end_cycles is not None else self.cpu.cycles)
+        seconds = (self.end_time or time.perf_counter()) - self.start_time
+        cycles -= self.start_cycles
+        return {
+            "cycles": cycles,
+            "seconds": seconds,
+            "instructions_per_second": cycles / seconds if seconds else 0.0,
+            "opcodes": {
+                hd.NAMES.get(opcode, f"{opcode:08b}"): count
+                for opcode, count in enumerate(self.opcodes) if count
+            },
+            "pcs": {pc: count for pc, count in enumerate(self.pcs) if count},
+            "locations": {
+                pc: self.cpu.source_map.describe(pc)
+                for pc, count in enumerate(self.pcs) if count
+            } if self.cpu.source_map else {},
+            "branches": {
+                pc: {"taken": taken, "not_taken": not_taken}
+                for pc, (taken, not_taken) in sorted(self.branches.items())
+            },
+        }
+
+    def where(self, pc):
+        """The label and source line of pc for the report, if there is a
+        source map"""
+        source_map = self.cpu.source_map
+        where = source_map and source_map.describe(pc)
+        return f"  {where}" if where else ""
+
+    def to_json(self):
+        return json.dumps(self.results(), indent=2)
+
+    def report(self):
+        """Return the results as flat text, busiest first"""
+        results = self.results()
+        lines = [
+            f"cycles {results['cycles']}",
+            f"seconds {results['seconds']:.6f}",
+            f"instructions/sec {results['instructions_per_second']:.0f}",
+            "",
+            "opcode       count",
+        ]
+        for name, count in sorted(results["opcodes"].items(), key=lambda item: -item[1]):
+            lines.append(f"{name:8}{count:>10}")
+
+        lines += ["", "address      count"]
+        for pc, count in sorted(results["pcs"].items(), key=lambda item: -item[1]):
+            lines.append(f"{pc:8}{count:>10}{self.where(pc)}")
+
+        if results["branches"]:
+            lines += ["", "branch       taken  not taken"]
+            for pc, counts in results["branches"].items():
+                lines.append(f"{pc:8}{counts['taken']:>10}{counts['not_taken']:>11}"
+                             f"{self.where(pc)}")
+
+        return "\n".join(lines)
@@ -0,0 +1,75 @@
+"""Record and replay the timer ticks and key presses a program gets.
+
+Every external event reaches the CPU in poll() (or between two step()s),
+so it is stamped with the instruction count at which the program saw it.
+A Recorder logs them, a Replay delivers them again at the same counts with
+no clock or keyboard involved:
+
+    cpu.recorder = Recorder()
+    cpu.run()
+    cpu.recorder.save("session.events")
+
+    cpu.replay = Replay.load("session.events")
+    cpu.run(interactive=False)
+
+Events are JSON lines such as {"cycle": 5000, "event": "key", "key": 104}.
+The interpreter polls at exactly the recorded counts; with --jit an event
+lands at the end of the compiled block that contains its count.
+"""
+
+import json
+import helpers as hp
+
+
+class Recorder:
+    """Keeps every event the CPU delivers."""
+
+    def __init__(self):
+        self.events = []  # (cycle, event, key)
+
+    def record(self, cycle, event, key=None):
+        self.events.append((cycle, event, key))
+
+    def save(self, file_name):
+        with open(file_name, "w") as fp:
+            for cycle, event, key in self.events:
+                line = {"cycle": cycle, "event": event}
+                if key is not None:
+                    line["key"] = key
+                fp.write(json.dumps(line) + "\n")
+
+
+class Replay:
+    """Delivers recorded events at their instruction counts."""
+
+    def __init__(self, events):
+        self.events = sorted(events, key=lambda event: event[0])
+        self.index = 0  # the next event to deliver
+
+    @classmethod
+    def load(cls, file_name):
+        events = []
+        with open(file_name) as fp:
+            for line in fp:
+                if line.strip():
+                    event = json.loads(line)
+                    events.append((event["cycle"], event["event"], event.get("key")))
+        return cls(events)
+
+    def deliver(self, cpu, cycles):
+        """Deliver the events due by cycles, returns the count of the next
+        one, or None when there are no more"""
+        events = self.events
+        while self.index < len(events) and events[self.index][0] <= cycles:
+            cycle, event, key = events[self.index]
+            self.index += 1
+            if event == "timer":
+                hp.run_timer_interrupt(cpu)
+            elif event == "key":
+                hp.run_key_interrupt(cpu, key)
+            else:
+                raise ValueError(f"Unknown event {event!r} at cycle {cycle}")
+
+        if self.index < len(events):
+            return events[self.index][0]
+        return None
@@ -0,0 +1,122 @@
+"""Time-slice many CPUs in one asyncio event loop.
+
+    scheduler = Scheduler()
+    session = scheduler.add(cpu)
+    ...
+    await session.press("a")
+    ...
+    await scheduler.run()
+    status = await session.wait()
+
+Every CPU runs slice instructions at a time through CPU.step() and the
+event loop gets a turn after each round, so a key press or a timer tick
+reaches its machine within one round, however many machines there are.
+The timer and the keyboard are event loop events here: each session has a
+task firing the timer every timer_interval seconds and an asyncio.Queue of
+key presses, instead of every CPU looking at the wall clock and hooking
+the keyboard.
+"""
+
+import asyncio
+import helpers as hp
+from faults import Fault
+
+# instructions a CPU runs before the next one gets its turn
+SLICE = 1000
+
+
+class Session:
+    """One CPU in a Scheduler, with its timer and keyboard."""
+
+    def __init__(self, cpu, timer_interval=1.0):
+        self.cpu = cpu
+        self.timer_interval = timer_interval  # seconds, None for no timer
+        self.keys = asyncio.Queue()
+        self.finished = asyncio.Event()
+        self.status = None  # why the program stopped
+        self.fault = None  # the Fault or other exception that stopped it
+        self.started = False
+        self.timer_task = None
+
+        # poll() takes keys from read_key(), the timer comes from tick()
+        cpu.poll_timer = False
+        cpu.input = self
+
+    async def press(self, key):
+        """Queue a key press, a character or a key code"""
+        await self.keys.put(key)
+
+    async def wait(self):
+        """Wait for the program to stop and return why it did"""
+        await self.finished.wait()
+        return self.status
+
+    def read_key(self):
+        """The next queued key for CPU.poll(), or None"""
+        if self.keys.empty():
+            return None
+        key = self.keys.get_nowait()
+        return (ord(key) if isinstance(key, str) else key) & 0xFF
+
+    async def tick(self):
+        while True:
+            await asyncio.sleep(self.timer_interval)
+            hp.run_timer_interrupt(self.cpu)
+
+    def start(self):
+        self.started = True
+        if self.timer_interval is not None:
+            self.timer_task = asyncio.create_task(self.tick())
+
+    def step(self, budget):
+        """Run one slice, returns None or why the program stopped"""
+        try:
+            return self.cpu.step(budget)
+        except Fault as fault:
+            # only this machine stops
+            self.fault = fault
+            return fault.reason
+        except Exception as error:
+            # a bug in the emulator or a device, again only this machine
+            # stops
+            self.fault = error
+            return f"error: {error}"
+
+    def finish(self, status):
+        if self.timer_task is not None:
+            self.timer_task.cancel()
+        self.status = status
+        self.finished.set()
+
+
+class Scheduler:
+    """Runs the CPUs of all its sessions round robin."""
+
+    def __init__(self, slice=SLICE):
+        self.slice = slice
+        self.sessions = []
+
+    def add(self, cpu, timer_interval=1.0):
+        """Add a loaded CPU, it starts with the next round"""
+        session = Session(cpu, timer_interval)
+        self.sessions.append(session)
+        return session
+
+    async def run(self):
+        """Run rounds until every program stopped"""
+        try:
+            while self.sessions:
+                for session in list(self.sessions):
+                    if not session.started:
+                        session.start()
+                    status = session.step(self.slice)
+                    if status is not None:
+                        session.finish(status)
+                        self.sessions.remove(session)
+                # let the timers, key presses and anything else run
+                await asyncio.sleep(0)
+        finally:
+            # cancelled, stop the timers and don't leave anyone waiting
+            for session in self.sessions:
+                session.finish("cancelled")
+            self.sessions.clear()
@@ -0,0 +1,71 @@
+"""Source maps written by the assembler.
+
+`asm.py -g prog.asm prog.ls8` (or `build.py -g`) writes prog.ls8.map next
+to the program, JSON mapping every address to its source line, the label
+it comes under and the text of the instruction or data there. CPU.load()
+picks it up as cpu.source_map, and programs assembled in memory get one
+too. The profiler report, stack fault messages and the debugger then name
+addresses like "PRINTSTR_LOOP+3 (printstr.asm:12)" instead of as raw PCs.
+"""
+
+import json
+import os
+import sys
+
+# the file next to a program, see DEBUG_SUFFIX in asm.py
+SUFFIX = ".map"
+VERSION = 1
+
+
+class SourceMap:
+    """Source line, label and text of every address of a program."""
+
+    def __init__(self, info):
+        if info.get("version") != VERSION:
+            raise ValueError(f"unsupported source map version {info.get('version')}")
+        self.source = info["source"]
+        self.symbols = info["symbols"]  # label -> address
+        self.addresses = info["addresses"]  # {"line", "label", "text"} by address
+
+    @classmethod
+    def load(cls, file_name):
+        with open(file_name) as fp:
+            return cls(json.load(fp))
+
+    def entry(self, address):
+        """The address's {"line", "label", "text"}, None outside the program"""
+        if 0 <= address < len(self.addresses):
+            return self.addresses[address]
+        return None
+
+    def label(self, address):
+        """The address as LABEL or LABEL+offset, or None"""
+        entry = self.entry(address)
+        if entry is None or entry["label"] is None:
+            return None
+        offset = address - self.symbols[entry["label"]]
+        return f"{entry['label']}+{offset}" if offset else entry["label"]
+
+    def describe(self, address):
+        """The address as e.g. "PRINTSTR_LOOP+3 (printstr.asm:12)", or None
+        outside the program"""
+        entry = self.entry(address)
+        if entry is None:
+            return None
+        line = f"{self.source}:{entry['line']}"
+        label = self.label(address)
+        return f"{label} ({line})" if label else line
+
+
+def find(program_file):
+    """The source map next to program_file, or None if it has none. A map
+    that can't be read (stale, from another assembler version) is only
+    debug info, so it is skipped with a warning."""
+    file_name = program_file + SUFFIX
+    if not os.path.exists(file_name):
+        return None
+    try:
+        return SourceMap.load(file_name)
+    except (OSError, ValueError, KeyError, TypeError) as error:
+        print(f"warning: ignoring source map {file_name}: {error}", file=sys.stderr)
+        return None